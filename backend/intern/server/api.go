@@ -1,33 +1,174 @@
 package server
 
 import (
+	"compress/gzip"
+	"encoding/csv"
 	"encoding/json"
 	"fmt"
 	"io"
 	"log"
 	"net/http"
+	"os"
+	"path/filepath"
 	"strconv"
 	"time"
 
 	"backend/intern/types"
 
 	"github.com/gin-gonic/gin"
-	"github.com/gocelery/gocelery"
+	redigo "github.com/gomodule/redigo/redis"
 )
 
 var analyses = map[int]*types.Analysis{}
 var reviews = map[int]*types.Review{}
 var clusters = map[int]*types.Cluster{}
-var asyncResults = map[int]*gocelery.AsyncResult{}
 
 var nextAnalysisID = 1
 var nextReviewID = 1
 var nextClusterID = 1
 
+// resultFormat asks the worker for one array per review field instead of a list of objects.
+const resultFormat = "columnar"
+
 type WorkerResult struct {
-	Status   string          `json:"status"`
-	Reviews  []WorkerReview  `json:"reviews"`
-	Clusters []WorkerCluster `json:"clusters"`
+	Status        string               `json:"status"`
+	Format        string               `json:"format"`
+	Reviews       []WorkerReview       `json:"reviews"`
+	ReviewColumns *WorkerReviewColumns `json:"review_columns"`
+	Artifact      *WorkerArtifact      `json:"artifact"`
+	Clusters      []WorkerCluster      `json:"clusters"`
+	RefitRequired []string             `json:"refit_required"`
+}
+
+type WorkerArtifact struct {
+	Path     string `json:"path"`
+	Encoding string `json:"encoding"`
+}
+
+type WorkerReviewColumns struct {
+	SourceID   []string  `json:"source_id"`
+	Text       []string  `json:"text"`
+	Sentiment  []string  `json:"sentiment"`
+	Confidence []float64 `json:"confidence"`
+	ClusterID  []int     `json:"cluster_id"`
+	X          []float64 `json:"x"`
+	Y          []float64 `json:"y"`
+	Row        []int     `json:"row"`
+}
+
+// loadArtifact reads review columns that the worker wrote to RESULT_STORE_DIR.
+// Artifacts of uploads sent by reference carry no review text; it is filled in
+// by row number from the copy of the upload on SHARED_DATA_DIR.
+func loadArtifact(artifact *WorkerArtifact, uploadPath string) (*WorkerReviewColumns, error) {
+	if artifact.Encoding != "json+gzip" {
+		return nil, fmt.Errorf("unsupported artifact encoding %q", artifact.Encoding)
+	}
+
+	path := filepath.Join(os.Getenv("RESULT_STORE_DIR"), filepath.Base(artifact.Path))
+	f, err := os.Open(path)
+	if err != nil {
+		return nil, err
+	}
+	defer f.Close()
+
+	zr, err := gzip.NewReader(f)
+	if err != nil {
+		return nil, err
+	}
+	defer zr.Close()
+
+	var columns WorkerReviewColumns
+	if err := json.NewDecoder(zr).Decode(&columns); err != nil {
+		return nil, err
+	}
+
+	if len(columns.Text) == len(columns.Row) {
+		os.Remove(path)
+		return &columns, nil
+	}
+
+	if uploadPath == "" {
+		return nil, fmt.Errorf("artifact results need SHARED_DATA_DIR to join review text")
+	}
+	upload, err := os.Open(uploadPath)
+	if err != nil {
+		return nil, fmt.Errorf("open upload: %w", err)
+	}
+	defer upload.Close()
+
+	texts, err := csvTexts(upload)
+	if err != nil {
+		return nil, err
+	}
+	columns.Text = make([]string, len(columns.Row))
+	for i, row := range columns.Row {
+		if row < 0 || row >= len(texts) {
+			return nil, fmt.Errorf("row %d is not in the upload", row)
+		}
+		columns.Text[i] = texts[row]
+	}
+
+	os.Remove(path)
+	return &columns, nil
+}
+
+// csvTexts returns the text column of an uploaded CSV, indexed by data row.
+func csvTexts(upload io.Reader) ([]string, error) {
+	r := csv.NewReader(upload)
+	r.FieldsPerRecord = -1
+	r.LazyQuotes = true
+
+	header, err := r.Read()
+	if err != nil {
+		return nil, err
+	}
+	textCol := -1
+	for i, name := range header {
+		if name == "text" {
+			textCol = i
+		}
+	}
+	if textCol < 0 {
+		return nil, fmt.Errorf("no text column in upload")
+	}
+
+	var texts []string
+	for {
+		record, err := r.Read()
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			return nil, err
+		}
+		text := ""
+		if textCol < len(record) {
+			text = record[textCol]
+		}
+		texts = append(texts, text)
+	}
+	return texts, nil
+}
+
+func (c *WorkerReviewColumns) records() ([]WorkerReview, error) {
+	n := len(c.SourceID)
+	if len(c.Text) != n || len(c.Sentiment) != n || len(c.Confidence) != n ||
+		len(c.ClusterID) != n || len(c.X) != n || len(c.Y) != n {
+		return nil, fmt.Errorf("review columns have different lengths")
+	}
+
+	out := make([]WorkerReview, n)
+	for i := range out {
+		out[i] = WorkerReview{
+			SourceID:   c.SourceID[i],
+			Text:       c.Text[i],
+			Sentiment:  c.Sentiment[i],
+			Confidence: c.Confidence[i],
+			ClusterID:  c.ClusterID[i],
+			Coords:     WorkerCoords{X: c.X[i], Y: c.Y[i]},
+		}
+	}
+	return out, nil
 }
 
 type WorkerReview struct {
@@ -90,7 +231,14 @@ func createAnalysis(c *gin.Context) {
 
 	taskArgID := fmt.Sprintf("analysis-%d", nextAnalysisID)
 
-	asyncResult, err := cli.Delay("worker.process_file", string(csvData), taskArgID)
+	payload, err := taskPayload(taskArgID, csvData)
+	if err != nil {
+		log.Printf("store upload error: %v", err)
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "cannot store file"})
+		return
+	}
+
+	asyncResult, err := cli.Delay("worker.process_file", payload, taskArgID, resultFormat, resultStore())
 	if err != nil {
 		log.Printf("celery delay error: %v", err)
 		c.JSON(http.StatusInternalServerError, gin.H{"error": "failed to send task"})
@@ -107,12 +255,234 @@ func createAnalysis(c *gin.Context) {
 		TaskID:    asyncResult.TaskID,
 	}
 	analyses[nextAnalysisID] = analysis
-	asyncResults[nextAnalysisID] = asyncResult
 	nextAnalysisID++
 
 	c.JSON(http.StatusOK, analysis)
 }
 
+// appendReviews assigns a new batch of reviews to the clusters of a finished
+// analysis without refitting it. The batch becomes an analysis of its own,
+// holding the reviews of the base and the batch, and can itself be appended
+// to. If the worker finds categories that no longer fit, a full refit over
+// those reviews is started and shows up as the analysis in refit_analysis_id.
+func appendReviews(c *gin.Context) {
+	baseID, _ := strconv.Atoi(c.Param("id"))
+	base, ok := analyses[baseID]
+	if !ok {
+		c.JSON(http.StatusNotFound, gin.H{"error": "not found"})
+		return
+	}
+	if base.Status != "done" {
+		c.JSON(http.StatusConflict, gin.H{"error": "analysis is not finished"})
+		return
+	}
+
+	fileHeader, err := c.FormFile("file")
+	if err != nil {
+		c.JSON(http.StatusBadRequest, gin.H{"error": "file is required"})
+		return
+	}
+
+	f, err := fileHeader.Open()
+	if err != nil {
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "cannot open file"})
+		return
+	}
+	defer f.Close()
+
+	csvData, err := io.ReadAll(f)
+	if err != nil {
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "cannot read file"})
+		return
+	}
+
+	id := nextAnalysisID
+	taskArgID := fmt.Sprintf("analysis-%d", id)
+
+	payload, err := taskPayload(taskArgID, csvData)
+	if err != nil {
+		log.Printf("store upload error: %v", err)
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "cannot store file"})
+		return
+	}
+
+	asyncResult, err := cli.Delay(
+		"worker.append_reviews",
+		payload,
+		taskArgID,
+		fmt.Sprintf("analysis-%d", baseID),
+		resultFormat,
+		resultStore(),
+	)
+	if err != nil {
+		log.Printf("celery delay error: %v", err)
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "failed to send task"})
+		return
+	}
+
+	analysis := &types.Analysis{
+		ID:             id,
+		Status:         "pending",
+		Filename:       fileHeader.Filename,
+		CreatedAt:      time.Now(),
+		TaskID:         asyncResult.TaskID,
+		BaseAnalysisID: &baseID,
+	}
+	analyses[id] = analysis
+	nextAnalysisID++
+
+	c.JSON(http.StatusOK, analysis)
+}
+
+// startRefit sends a full re-analysis of the reviews persisted for an append,
+// base reviews included, as a new analysis.
+func startRefit(a *types.Analysis) {
+	refitID := nextAnalysisID
+
+	asyncResult, err := cli.Delay(
+		"worker.refit_analysis",
+		fmt.Sprintf("analysis-%d", a.ID),
+		fmt.Sprintf("analysis-%d", refitID),
+		resultFormat,
+		resultStore(),
+	)
+	if err != nil {
+		log.Printf("celery delay error: %v", err)
+		return
+	}
+
+	analyses[refitID] = &types.Analysis{
+		ID:        refitID,
+		Status:    "pending",
+		Filename:  a.Filename,
+		CreatedAt: time.Now(),
+		TaskID:    asyncResult.TaskID,
+	}
+	a.RefitAnalysisID = &refitID
+	nextAnalysisID++
+}
+
+// taskPayload hands large uploads to the worker by reference: when SHARED_DATA_DIR
+// is set the CSV is written to the shared volume and only a file:// path is sent.
+func taskPayload(taskArgID string, csvData []byte) (string, error) {
+	sharedDir := os.Getenv("SHARED_DATA_DIR")
+	if sharedDir == "" {
+		return string(csvData), nil
+	}
+
+	name := taskArgID + ".csv"
+	if err := os.WriteFile(filepath.Join(sharedDir, name), csvData, 0o644); err != nil {
+		return "", err
+	}
+	return "file://" + name, nil
+}
+
+// sharedUploadPath is where taskPayload stores the upload of an analysis,
+// or "" when uploads are sent inline.
+func sharedUploadPath(id int) string {
+	sharedDir := os.Getenv("SHARED_DATA_DIR")
+	if sharedDir == "" {
+		return ""
+	}
+	return filepath.Join(sharedDir, fmt.Sprintf("analysis-%d.csv", id))
+}
+
+// removeSharedUpload deletes the copy of an analysis upload that taskPayload
+// wrote to the shared volume, once the worker no longer needs it.
+func removeSharedUpload(id int) {
+	path := sharedUploadPath(id)
+	if path == "" {
+		return
+	}
+	if err := os.Remove(path); err != nil && !os.IsNotExist(err) {
+		log.Printf("remove shared upload error: %v", err)
+	}
+}
+
+// taskMeta is the state of a task as stored in the Celery result backend.
+type taskMeta struct {
+	Status string          `json:"status"`
+	Result json.RawMessage `json:"result"`
+}
+
+// fetchTaskMeta reads the task state from the Celery result backend. The
+// worker keeps it at PROGRESS with progress meta while the task runs, so it
+// must be checked before the result is decoded. A task without stored state
+// is reported as PENDING.
+func fetchTaskMeta(taskID string) (*taskMeta, error) {
+	conn := redisPool.Get()
+	defer conn.Close()
+
+	raw, err := redigo.Bytes(conn.Do("GET", "celery-task-meta-"+taskID))
+	if err == redigo.ErrNil {
+		return &taskMeta{Status: "PENDING"}, nil
+	}
+	if err != nil {
+		return nil, err
+	}
+
+	var meta taskMeta
+	if err := json.Unmarshal(raw, &meta); err != nil {
+		return nil, err
+	}
+	return &meta, nil
+}
+
+// listPartialResults returns the per-category results the worker has published
+// to the analysis stream so far. Clients pass the last entry id they have seen
+// as ?after= to receive only newer entries; an entry with event "done" ends the stream.
+func listPartialResults(c *gin.Context) {
+	id, _ := strconv.Atoi(c.Param("id"))
+	if _, ok := analyses[id]; !ok {
+		c.JSON(http.StatusNotFound, gin.H{"error": "not found"})
+		return
+	}
+
+	start := "-"
+	if after := c.Query("after"); after != "" {
+		start = "(" + after
+	}
+
+	conn := redisPool.Get()
+	defer conn.Close()
+
+	key := fmt.Sprintf("analysis-stream:analysis-%d", id)
+	entries, err := redigo.Values(conn.Do("XRANGE", key, start, "+"))
+	if err != nil {
+		log.Printf("read result stream error: %v", err)
+		c.JSON(http.StatusInternalServerError, gin.H{"error": "failed to read partial results"})
+		return
+	}
+
+	data := []gin.H{}
+	for _, entry := range entries {
+		parts, err := redigo.Values(entry, nil)
+		if err != nil || len(parts) != 2 {
+			continue
+		}
+		entryID, _ := redigo.String(parts[0], nil)
+		fields, err := redigo.StringMap(parts[1], nil)
+		if err != nil {
+			continue
+		}
+		data = append(data, gin.H{
+			"id":    entryID,
+			"event": fields["event"],
+			"data":  json.RawMessage(fields["data"]),
+		})
+	}
+	c.JSON(http.StatusOK, gin.H{"data": data})
+}
+
+// resultStore asks the worker to write large results to the shared RESULT_STORE_DIR
+// and return only a manifest, instead of sending them through Redis.
+func resultStore() string {
+	if os.Getenv("RESULT_STORE_DIR") != "" {
+		return "artifact"
+	}
+	return "inline"
+}
+
 func listAnalyses(c *gin.Context) {
 	for id, a := range analyses {
 		if a.Status == "pending" {
@@ -128,49 +498,41 @@ func listAnalyses(c *gin.Context) {
 }
 
 func checkAnalysisResult(id int, a *types.Analysis) {
-	asyncResult, ok := asyncResults[id]
-	if !ok {
-		return
-	}
-
-	ready, err := asyncResult.Ready()
+	meta, err := fetchTaskMeta(a.TaskID)
 	if err != nil {
-		log.Printf("error checking task ready status: %v", err)
+		log.Printf("error reading task state: %v", err)
 		return
 	}
 
-	log.Printf("async result ready: %v", ready)
-
-	if !ready {
+	switch meta.Status {
+	case "SUCCESS", "FAILURE", "REVOKED":
+	case "PROGRESS":
+		var progress types.Progress
+		if err := json.Unmarshal(meta.Result, &progress); err == nil {
+			a.Progress = &progress
+		}
 		return
-	}
-
-	result, err := asyncResult.AsyncGet()
-	if err != nil {
-		log.Printf("error getting async result: %v", err)
-		errMsg := fmt.Sprintf("failed to get result: %v", err)
-		a.Status = "failed"
-		a.Error = &errMsg
-		delete(asyncResults, id)
+	default:
+		// PENDING, STARTED or RETRY
 		return
 	}
+	a.Progress = nil
+	defer removeSharedUpload(id)
 
-	raw, err := json.Marshal(result)
-	if err != nil {
-		log.Printf("marshal worker result error: %v", err)
-		errMsg := "invalid worker result format"
+	if meta.Status != "SUCCESS" {
+		log.Printf("task %s finished with state %s: %s", a.TaskID, meta.Status, meta.Result)
+		errMsg := "worker processing failed"
 		a.Status = "failed"
 		a.Error = &errMsg
-		delete(asyncResults, id)
 		return
 	}
+	raw := []byte(meta.Result)
 
 	var workerError WorkerError
 	if err := json.Unmarshal(raw, &workerError); err == nil && workerError.Status == "error" {
 		log.Printf("worker returned error: %s", workerError.Message)
 		a.Status = "failed"
 		a.Error = &workerError.Message
-		delete(asyncResults, id)
 		return
 	}
 
@@ -180,16 +542,39 @@ func checkAnalysisResult(id int, a *types.Analysis) {
 		errMsg := "invalid worker result structure"
 		a.Status = "failed"
 		a.Error = &errMsg
-		delete(asyncResults, id)
 		return
 	}
 
+	if workerResult.Format == "artifact" && workerResult.Artifact != nil {
+		columns, err := loadArtifact(workerResult.Artifact, sharedUploadPath(id))
+		if err != nil {
+			log.Printf("load result artifact error: %v", err)
+			errMsg := "failed to load worker result"
+			a.Status = "failed"
+			a.Error = &errMsg
+			return
+		}
+		workerResult.ReviewColumns = columns
+		workerResult.Format = "columnar"
+	}
+
+	if workerResult.Format == "columnar" && workerResult.ReviewColumns != nil {
+		records, err := workerResult.ReviewColumns.records()
+		if err != nil {
+			log.Printf("decode review columns error: %v", err)
+			errMsg := "invalid worker result structure"
+			a.Status = "failed"
+			a.Error = &errMsg
+			return
+		}
+		workerResult.Reviews = records
+	}
+
 	if workerResult.Status == "error" {
 		log.Printf("worker result status is error")
 		errMsg := "worker processing failed"
 		a.Status = "failed"
 		a.Error = &errMsg
-		delete(asyncResults, id)
 		return
 	}
 
@@ -246,7 +631,10 @@ func checkAnalysisResult(id int, a *types.Analysis) {
 		a.Stats = &stats
 	}
 
-	delete(asyncResults, id)
+	if len(workerResult.RefitRequired) > 0 {
+		log.Printf("analysis %d needs a refit for: %v", id, workerResult.RefitRequired)
+		startRefit(a)
+	}
 }
 
 func getAnalysis(c *gin.Context) {
@@ -270,7 +658,7 @@ func deleteAnalysis(c *gin.Context) {
 	id, _ := strconv.Atoi(strid)
 
 	delete(analyses, id)
-	delete(asyncResults, id)
+	removeSharedUpload(id)
 
 	for k, v := range reviews {
 		if v.AnalysisID == strid {
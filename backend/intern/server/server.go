@@ -15,6 +15,7 @@ var cli *gocelery.CeleryClient
 var redisPool *redigo.Pool
 
 func Start() {
+	checkStorageConfig()
 	initCelery()
 	r := gin.Default()
 
@@ -32,6 +33,8 @@ func Start() {
 	r.GET("/analyses", listAnalyses)
 	r.GET("/analyses/:id", getAnalysis)
 	r.DELETE("/analyses/:id", deleteAnalysis)
+	r.GET("/analyses/:id/partial", listPartialResults)
+	r.POST("/analyses/:id/append", appendReviews)
 
 	// Reviews
 	r.GET("/analyses/:id/reviews", listReviews)
@@ -45,6 +48,14 @@ func Start() {
 	r.Run(":8080")
 }
 
+// checkStorageConfig rejects RESULT_STORE_DIR without SHARED_DATA_DIR: artifact
+// results leave review text out and it is joined back from the shared upload.
+func checkStorageConfig() {
+	if os.Getenv("RESULT_STORE_DIR") != "" && os.Getenv("SHARED_DATA_DIR") == "" {
+		log.Fatalf("RESULT_STORE_DIR requires SHARED_DATA_DIR to be set as well")
+	}
+}
+
 func initCelery() {
 	redisHost := os.Getenv("REDIS_HOST")
 	if redisHost == "" {
@@ -14,7 +14,25 @@ type Analysis struct {
 	CreatedAt time.Time `json:"created_at"`
 	Error     *string   `json:"error"`
 	Stats     *Stats    `json:"stats"`
+	Progress  *Progress `json:"progress"`
 	TaskID    string    `json:"-"`
+	// Set on analyses that append reviews to a finished analysis
+	BaseAnalysisID *int `json:"base_analysis_id,omitempty"`
+	// Full re-analysis started because the appended reviews did not fit the base clusters
+	RefitAnalysisID *int `json:"refit_analysis_id,omitempty"`
+}
+
+// Progress mirrors the PROGRESS state meta published by the worker.
+type Progress struct {
+	Stage           string             `json:"stage"`
+	Percent         int                `json:"percent"`
+	CategoryIndex   int                `json:"category_index"`
+	TotalCategories int                `json:"total_categories"`
+	RowsDone        int                `json:"rows_done"`
+	RowsTotal       int                `json:"rows_total"`
+	Elapsed         float64            `json:"elapsed"`
+	StageElapsed    map[string]float64 `json:"stage_elapsed"`
+	PollAfter       float64            `json:"poll_after"`
 }
 
 type Stats struct {
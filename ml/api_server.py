@@ -1,25 +1,183 @@
+import asyncio
 import os
-from typing import List, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 
-import torch
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-from preprocess import batch_clean_text
+from prediction_cache import PredictionCache
+from sentiment_engine import TIER_NAMES, SentimentEngine
+from utils.instrumentation import Metrics
 
 
 MODEL_DIR = os.getenv("MODEL_DIR", "checkpoints")
 MAX_LENGTH = int(os.getenv("MAX_LENGTH", "256"))
-
-app = FastAPI(title="Sentiment API", version="1.0.0")
-
-tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR, use_fast=True)
-model = AutoModelForSequenceClassification.from_pretrained(MODEL_DIR)
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
-model.eval()
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "5"))
+BATCH_MAX_TEXTS = int(os.getenv("BATCH_MAX_TEXTS", "64"))
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "torch")
+SENTIMENT_DEVICE = os.getenv("SENTIMENT_DEVICE") or None
+SENTIMENT_THREADS = int(os.getenv("SENTIMENT_THREADS", "0"))
+SENTIMENT_TOKEN_BUDGET = int(os.getenv("SENTIMENT_TOKEN_BUDGET", "8192"))
+SENTIMENT_ONNX_PATH = os.getenv("SENTIMENT_ONNX_PATH") or None
+# Cascade: a fast n-gram model (train.py --fast_model_path) answers confident texts first
+SENTIMENT_FAST_MODEL = os.getenv("SENTIMENT_FAST_MODEL") or None
+SENTIMENT_CASCADE_THRESHOLD = float(os.getenv("SENTIMENT_CASCADE_THRESHOLD", "0.9"))
+# Predictions memoized by text hash; 0 disables, an empty Redis URL keeps it in-process
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "100000"))
+PREDICTION_CACHE_REDIS_URL = os.getenv("PREDICTION_CACHE_REDIS_URL", "")
+PREDICTION_CACHE_TTL_S = int(os.getenv("PREDICTION_CACHE_TTL_S", str(7 * 24 * 3600)))
+
+metrics = Metrics("sentiment_api")
+cache = (
+    PredictionCache(
+        PREDICTION_CACHE_SIZE,
+        redis_url=PREDICTION_CACHE_REDIS_URL or None,
+        ttl_seconds=PREDICTION_CACHE_TTL_S,
+    )
+    if PREDICTION_CACHE_SIZE > 0
+    else None
+)
+engine = SentimentEngine(
+    MODEL_DIR,
+    backend=SENTIMENT_BACKEND,
+    device=SENTIMENT_DEVICE,
+    threads=SENTIMENT_THREADS,
+    token_budget=SENTIMENT_TOKEN_BUDGET,
+    max_length=MAX_LENGTH,
+    metrics=metrics,
+    onnx_path=SENTIMENT_ONNX_PATH,
+    fast_model_path=SENTIMENT_FAST_MODEL,
+    cascade_threshold=SENTIMENT_CASCADE_THRESHOLD,
+    cache=cache,
+)
+
+
+def run_model(texts: List[str]) -> Tuple[List[int], List[List[float]], List[int]]:
+    probs, tiers = engine.predict_proba_with_tiers(texts)
+    return probs.argmax(axis=1).tolist(), probs.tolist(), tiers.tolist()
+
+
+class MicroBatcher:
+    """
+    Collects concurrent /predict calls for up to `max_wait_ms` or `max_texts`
+    texts, runs them through the engine together and hands every caller back
+    its own slice.
+    """
+
+    def __init__(self, max_wait_ms: float, max_texts: int) -> None:
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_texts = max_texts
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        # The model is not thread-safe, so forwards run one at a time off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+        self.max_batch_texts = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, texts: List[str]) -> Tuple[List[int], List[List[float]], List[int]]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        n_texts = len(pending[0][0])
+        deadline = loop.time() + self.max_wait
+        while n_texts < self.max_texts:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            pending.append(item)
+            n_texts += len(item[0])
+        return pending
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self._collect()
+            started = time.perf_counter()
+            texts = [text for item in pending for text in item[0]]
+            self._record(pending, len(texts), started)
+
+            try:
+                labels, probs, tiers = await loop.run_in_executor(self.executor, run_model, texts)
+            except Exception as e:
+                for _, future, _ in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for item_texts, future, _ in pending:
+                end = offset + len(item_texts)
+                if not future.done():
+                    future.set_result((labels[offset:end], probs[offset:end], tiers[offset:end]))
+                offset = end
+
+    def _record(self, pending: list, n_texts: int, started: float) -> None:
+        self.batches += 1
+        self.requests += len(pending)
+        self.texts += n_texts
+        self.max_batch_texts = max(self.max_batch_texts, n_texts)
+        for _, _, enqueued in pending:
+            wait = started - enqueued
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "texts": self.texts,
+            "avg_batch_texts": self.texts / self.batches if self.batches else 0.0,
+            "avg_batch_requests": self.requests / self.batches if self.batches else 0.0,
+            "max_batch_texts": self.max_batch_texts,
+            "avg_queue_wait_ms": 1000.0 * self.queue_wait_total / self.requests if self.requests else 0.0,
+            "max_queue_wait_ms": 1000.0 * self.queue_wait_max,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_texts": self.max_texts,
+        }
+
+
+batcher = MicroBatcher(BATCH_WAIT_MS, BATCH_MAX_TEXTS)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await batcher.start()
+    yield
+    await batcher.stop()
+
+
+app = FastAPI(title="Sentiment API", version="1.0.0", lifespan=lifespan)
 
 
 class PredictRequest(BaseModel):
@@ -29,6 +187,8 @@ class PredictRequest(BaseModel):
 class PredictResponse(BaseModel):
     labels: List[int]
     probs: List[List[float]]
+    # Share of this request's texts answered by each cascade tier
+    tiers: Dict[str, float] = {}
 
 
 @app.get("/health")
@@ -36,23 +196,33 @@ def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/stats")
+def stats() -> dict:
+    return batcher.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics() -> str:
+    gauges = {
+        f"batcher_{name}": value
+        for name, value in batcher.stats().items()
+        if name not in ("batches", "requests", "texts")
+    }
+    if cache is not None:
+        gauges.update({f"prediction_cache_{name}": value for name, value in cache.stats().items()})
+    return metrics.render_prometheus(extra_gauges=gauges)
+
+
 @app.post("/predict", response_model=PredictResponse)
-def predict(req: PredictRequest) -> PredictResponse:
-    cleaned = batch_clean_text(req.texts)
-    batch = tokenizer(
-        cleaned,
-        padding=True,
-        truncation=True,
-        max_length=MAX_LENGTH,
-        return_tensors="pt",
-    ).to(device)
-
-    with torch.no_grad():
-        logits = model(**batch).logits
-        probs = torch.softmax(logits, dim=-1).cpu().tolist()
-        labels = torch.argmax(logits, dim=-1).cpu().tolist()
-
-    return PredictResponse(labels=labels, probs=probs)
+async def predict(req: PredictRequest) -> PredictResponse:
+    if not req.texts:
+        return PredictResponse(labels=[], probs=[])
+    labels, probs, tiers = await batcher.submit(req.texts)
+    return PredictResponse(
+        labels=labels,
+        probs=probs,
+        tiers={name: tiers.count(tier) / len(tiers) for tier, name in TIER_NAMES.items()},
+    )
 
 
 if __name__ == "__main__":
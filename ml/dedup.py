@@ -0,0 +1,114 @@
+from collections import defaultdict
+from typing import List, Tuple
+
+import numpy as np
+
+# Mersenne prime for the universal hash family of the MinHash permutations
+_PRIME = np.uint64((1 << 61) - 1)
+_SHINGLE_BASE = np.uint64(1000003)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def shingle_hashes(text: str, shingle_size: int = 5) -> np.ndarray:
+    """Unique 32-bit rolling hashes of the character shingles of `text`."""
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) == 0:
+        return codes
+    k = min(shingle_size, len(codes))
+    hashes = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    for j in range(k):
+        hashes = (hashes * _SHINGLE_BASE + codes[j : len(codes) - k + 1 + j]) & _MASK32
+    return np.unique(hashes)
+
+
+def lsh_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Picks (bands, rows) with bands * rows == num_perm. Takes the most rows
+    whose candidate threshold (1 / bands) ** (1 / rows) stays at or below
+    `threshold`, so true near-duplicates are rarely missed; false candidates
+    are dropped by the signature check.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1.0 / bands) ** (1.0 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+def near_duplicate_groups(
+    texts: List[str],
+    threshold: float = 0.9,
+    num_perm: int = 64,
+    shingle_size: int = 5,
+    seed: int = 42,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Groups exact and near-duplicate texts. Exact duplicates are found by
+    hashing; the remaining texts are compared with MinHash signatures of
+    their character shingles, bucketed by LSH, and paired when the estimated
+    Jaccard similarity reaches `threshold`.
+
+    Returns `(representatives, inverse)` like `np.unique`: the position of
+    the first text of every group, and the group of every text.
+    """
+    parent = np.arange(len(texts))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        i, j = find(i), find(j)
+        if i != j:
+            # The earlier text stays the root, so it becomes the representative
+            parent[max(i, j)] = min(i, j)
+
+    first_seen = {}
+    unique = []
+    for i, text in enumerate(texts):
+        key = " ".join(text.lower().split())
+        if key in first_seen:
+            union(first_seen[key], i)
+        else:
+            first_seen[key] = i
+            unique.append((i, key))
+
+    rng = np.random.RandomState(seed)
+    # Products wrap around 2**64 before the modulo, which mixes better than
+    # keeping them exact with small multipliers
+    a = rng.randint(1, _PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, _PRIME, size=num_perm, dtype=np.uint64)
+
+    positions, signatures = [], []
+    for i, key in unique:
+        hashes = shingle_hashes(key, shingle_size)
+        if len(hashes) == 0:
+            continue
+        positions.append(i)
+        signatures.append(
+            (((a[:, None] * hashes[None, :] + b[:, None]) % _PRIME) & _MASK32).min(axis=1)
+        )
+
+    if signatures:
+        signatures = np.stack(signatures)
+        bands, rows = lsh_bands(num_perm, threshold)
+        for band in range(bands):
+            buckets = defaultdict(list)
+            band_values = signatures[:, band * rows : (band + 1) * rows]
+            for row, values in enumerate(band_values):
+                buckets[values.tobytes()].append(row)
+            for members in buckets.values():
+                # Star comparisons against the bucket's first text keep this linear
+                head = members[0]
+                for row in members[1:]:
+                    if np.mean(signatures[head] == signatures[row]) >= threshold:
+                        union(positions[head], positions[row])
+
+    roots = np.array([find(i) for i in range(len(texts))], dtype=np.int64)
+    representatives, inverse = np.unique(roots, return_inverse=True)
+    return representatives, inverse
@@ -0,0 +1,253 @@
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Append-only on-disk store of sentence embeddings keyed by a hash of the
+    text and the model name.
+
+    Layout of the cache directory (one per model):
+    - `index.npz`: row -> content hash, the embedding dimension and the
+      generation of the data files; replaced atomically
+    - `vectors-<generation>.f16`: float16 matrix, one row per cached text,
+      read through np.memmap
+    - `atime-<generation>.i8`: row -> last access time, updated in place and
+      used for size-based eviction
+    Appends write the data files before the index, and eviction writes a new
+    generation before switching the index to it, so a writer that dies leaves
+    at most unindexed rows or files, which the next writer drops.
+    Writers take an exclusive flock, so several worker processes can share it.
+    """
+
+    def __init__(self, directory: str, model_name: str, max_bytes: int) -> None:
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.directory = os.path.join(directory, re.sub(r"[^\w.-]+", "_", model_name))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.index_path = os.path.join(self.directory, "index.npz")
+        self.lock_path = os.path.join(self.directory, ".lock")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._keys = np.empty(0, dtype="<U32")
+        self._rows: Dict[str, int] = {}
+        self._dim: Optional[int] = None
+        self._generation = 0
+        self._index_mtime: Optional[int] = None
+        self._touched: Dict[str, int] = {}
+
+    def key(self, text: str) -> str:
+        payload = f"{self.model_name}\0{text}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.directory, f"vectors-{self._generation}.f16")
+
+    @property
+    def atime_path(self) -> str:
+        return os.path.join(self.directory, f"atime-{self._generation}.i8")
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh_index(self) -> None:
+        """Reloads the index if another process has rewritten it."""
+        if not os.path.exists(self.index_path):
+            return
+        mtime = os.stat(self.index_path).st_mtime_ns
+        if mtime == self._index_mtime:
+            return
+        with np.load(self.index_path) as index:
+            self._keys = index["keys"]
+            self._dim = int(index["dim"])
+            self._generation = int(index["generation"])
+
+        # Rows the index knows about but the vector file does not hold would
+        # read back as zeros; forget them instead
+        on_disk = 0
+        if os.path.exists(self.vectors_path):
+            on_disk = os.path.getsize(self.vectors_path) // (self._dim * 2)
+        if len(self._keys) > on_disk:
+            print(f"Embedding cache index has {len(self._keys)} rows, vectors {on_disk}")
+            self._keys = self._keys[:on_disk]
+
+        self._rows = {k: i for i, k in enumerate(self._keys.tolist())}
+        self._index_mtime = mtime
+
+    def _vectors(self) -> np.memmap:
+        return np.memmap(
+            self.vectors_path,
+            dtype=np.float16,
+            mode="r",
+            shape=(len(self._keys), self._dim),
+        )
+
+    def lookup(self, texts: List[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """
+        Returns the cached vectors by position in `texts` and the positions
+        that still have to be encoded.
+        """
+        keys = [self.key(t) for t in texts]
+        found: Dict[int, np.ndarray] = {}
+        missing: List[int] = []
+        now = int(time.time())
+
+        with self._locked(exclusive=False):
+            self._refresh_index()
+            rows = [self._rows.get(k) for k in keys]
+            hit_positions = [i for i, row in enumerate(rows) if row is not None]
+            if hit_positions:
+                vectors = self._vectors()
+                hit_rows = np.array([rows[i] for i in hit_positions])
+                hit_vectors = np.asarray(vectors[hit_rows], dtype=np.float32)
+                for i, vector in zip(hit_positions, hit_vectors):
+                    found[i] = vector
+                    self._touched[keys[i]] = now
+
+        missing = [i for i, row in enumerate(rows) if row is None]
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def add(self, texts: List[str], vectors: np.ndarray) -> None:
+        """Appends new vectors, then evicts the least recently used rows if over budget."""
+        vectors = np.asarray(vectors, dtype=np.float16)
+        now = int(time.time())
+
+        with self._locked(exclusive=True):
+            self._refresh_index()
+            if self._dim is None and len(vectors):
+                self._dim = vectors.shape[1]
+            if self._dim is None:
+                return
+            self._truncate_files()
+
+            new_keys, new_rows, seen = [], [], set()
+            for text, vector in zip(texts, vectors):
+                k = self.key(text)
+                if k in self._rows or k in seen:
+                    continue
+                seen.add(k)
+                new_keys.append(k)
+                new_rows.append(vector)
+
+            self._write_atimes()
+            if not new_rows:
+                return
+
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.atime_path, "ab") as f:
+                f.write(np.full(len(new_keys), now, dtype=np.int64).tobytes())
+            start = len(self._keys)
+            self._keys = np.concatenate([self._keys, np.array(new_keys, dtype="<U32")])
+            self._rows.update({k: start + i for i, k in enumerate(new_keys)})
+
+            if len(self._keys) * self._dim * 2 > self.max_bytes:
+                self._evict()
+            self._save_index()
+            self._remove_stale_files()
+
+    def flush(self) -> None:
+        """Persists access times recorded by lookups, in place."""
+        if not self._touched:
+            return
+        with self._locked(exclusive=True):
+            self._refresh_index()
+            if self._dim is not None:
+                self._truncate_files()
+            self._write_atimes()
+
+    def _truncate_files(self) -> None:
+        """
+        Fits the data files to the index: drops rows appended by a writer
+        that died before saving it, and zero-fills missing access times.
+        """
+        sizes = ((self.vectors_path, self._dim * 2), (self.atime_path, 8))
+        for path, row_bytes in sizes:
+            expected = len(self._keys) * row_bytes
+            if not os.path.exists(path) or os.path.getsize(path) != expected:
+                with open(path, "ab"):
+                    pass
+                os.truncate(path, expected)
+
+    def _write_atimes(self) -> None:
+        """Raises the stored access times of the rows looked up since the last write."""
+        touched = [(self._rows[k], t) for k, t in self._touched.items() if k in self._rows]
+        self._touched = {}
+        if not touched:
+            return
+        rows, times = (np.array(values) for values in zip(*touched))
+        atime = np.memmap(self.atime_path, dtype=np.int64, mode="r+", shape=(len(self._keys),))
+        atime[rows] = np.maximum(atime[rows], times)
+        atime.flush()
+
+    def _evict(self) -> None:
+        """Writes the most recently used rows as the next generation of data files."""
+        # Compact down to 90% of the budget so eviction does not run on every append
+        keep = int(0.9 * self.max_bytes) // (self._dim * 2)
+        atime = np.fromfile(self.atime_path, dtype=np.int64)
+        order = np.sort(np.argsort(-atime, kind="stable")[:keep])
+        kept_vectors = np.asarray(self._vectors()[order])
+
+        # The index still names the current generation until it is saved
+        self._generation += 1
+        with open(self.vectors_path, "wb") as f:
+            f.write(kept_vectors.tobytes())
+        with open(self.atime_path, "wb") as f:
+            f.write(atime[order].tobytes())
+
+        self.evictions += len(self._keys) - len(order)
+        self._keys = self._keys[order]
+        self._rows = {k: i for i, k in enumerate(self._keys.tolist())}
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                keys=self._keys,
+                dim=np.int64(self._dim),
+                generation=np.int64(self._generation),
+            )
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def _remove_stale_files(self) -> None:
+        """Deletes data files of older generations, including ones left by a crash."""
+        current = {self.vectors_path, self.atime_path}
+        patterns = ("vectors-*.f16", "atime-*.i8")
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                if path not in current:
+                    os.remove(path)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "rows": len(self._keys),
+            "bytes": len(self._keys) * (self._dim or 0) * 2,
+        }
@@ -1,20 +1,15 @@
 import argparse
+import time
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
-import torch
-from datasets import Dataset
 from sklearn.metrics import accuracy_score, classification_report
-from transformers import (
-    AutoModelForSequenceClassification,
-    AutoTokenizer,
-    DataCollatorWithPadding,
-    Trainer,
-    TrainingArguments,
-)
 
+from fast_classifier import FastClassifier
 from preprocess import batch_clean_text
+from sentiment_engine import BACKENDS, SentimentEngine
 from utils.metrics import macro_f1
 from utils.plots import plot_confusion_matrix
 
@@ -24,15 +19,66 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--model_dir", type=str, required=True, help="Path to saved model directory")
     parser.add_argument("--eval_path", type=str, default="train.csv", help="Path to labeled CSV for evaluation")
     parser.add_argument("--max_length", type=int, default=256)
-    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--token_budget", type=int, default=8192, help="Max padded tokens per forward pass")
+    parser.add_argument("--backend", type=str, default="torch", choices=BACKENDS)
+    parser.add_argument("--device", type=str, default=None, help="Defaults to cuda when available")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
     parser.add_argument("--save_probs", type=str, default="eval_outputs.csv", help="Where to save predictions + probabilities")
     parser.add_argument("--cm_path", type=str, default="confusion_matrix.png", help="Path to save confusion matrix PNG")
+    parser.add_argument("--teacher_dir", type=str, default=None, help="Teacher model to compare a distilled student against")
+    parser.add_argument("--fast_model", type=str, default=None, help="Cascade model (train.py --fast_model_path) to sweep thresholds for")
+    parser.add_argument("--thresholds", type=str, default="0.5,0.6,0.7,0.8,0.85,0.9,0.95,0.98", help="Comma-separated cascade thresholds")
+    parser.add_argument("--max_f1_loss", type=float, default=0.005, help="Macro-F1 loss vs. the transformer tolerated when picking a threshold")
     return parser.parse_args()
 
 
+def sweep_cascade(
+    fast_probs: np.ndarray,
+    probs: np.ndarray,
+    labels: np.ndarray,
+    thresholds: List[float],
+    max_f1_loss: float,
+) -> Optional[float]:
+    """
+    Reports macro-F1 and the share of texts answered by the fast model for
+    every threshold, and returns the lowest threshold (most traffic on the
+    fast tier) whose macro-F1 loss vs. the transformer stays within budget.
+    """
+    base_f1 = macro_f1(probs.argmax(axis=1), labels)["macro_f1"]
+    fast_conf, fast_preds = fast_probs.max(axis=1), fast_probs.argmax(axis=1)
+    best = None
+    print(f"Cascade sweep (transformer only: macro_f1 {base_f1:.4f})")
+    for threshold in sorted(thresholds):
+        confident = fast_conf >= threshold
+        preds = np.where(confident, fast_preds, probs.argmax(axis=1))
+        f1 = macro_f1(preds, labels)["macro_f1"]
+        print(
+            f"  threshold {threshold:.3f}: macro_f1 {f1:.4f} (loss {base_f1 - f1:+.4f}), "
+            f"fast tier {confident.mean():.1%}"
+        )
+        if best is None and base_f1 - f1 <= max_f1_loss:
+            best = threshold
+    return best
+
+
+def score(model_dir: str, df: pd.DataFrame, args: argparse.Namespace) -> Tuple[np.ndarray, float]:
+    """Returns class probabilities for `df` and the throughput in texts/sec."""
+    engine = SentimentEngine(
+        model_dir,
+        backend=args.backend,
+        device=args.device,
+        threads=args.threads,
+        token_budget=args.token_budget,
+        max_length=args.max_length,
+    )
+    engine.predict_proba(df["text"].head(32))  # warm-up
+    start = time.perf_counter()
+    probs = engine.predict_proba(df)
+    return probs, len(df) / (time.perf_counter() - start)
+
+
 def main() -> None:
     args = parse_args()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     df = pd.read_csv(args.eval_path)
     if "label" not in df.columns:
@@ -41,49 +87,39 @@ def main() -> None:
     df["text"] = batch_clean_text(df["text"].tolist())
     df["label"] = df["label"].astype(int)
 
-    dataset = Dataset.from_pandas(df.reset_index(drop=True))
-
-    tokenizer = AutoTokenizer.from_pretrained(args.model_dir, use_fast=True)
-    model = AutoModelForSequenceClassification.from_pretrained(args.model_dir).to(device)
-
-    def tokenize_function(examples):
-        return tokenizer(
-            examples["text"],
-            padding="max_length",
-            truncation=True,
-            max_length=args.max_length,
-        )
-
-    remove_cols = [c for c in dataset.column_names if c not in {"label"}]
-    tokenized_ds = dataset.map(tokenize_function, batched=True, remove_columns=remove_cols)
-    tokenized_ds = tokenized_ds.rename_column("label", "labels")
-    tokenized_ds.set_format(type="torch")
-
-    data_collator = DataCollatorWithPadding(tokenizer=tokenizer, pad_to_multiple_of=8)
-
-    training_args = TrainingArguments(
-        output_dir="eval_tmp",
-        per_device_eval_batch_size=args.batch_size,
-        report_to="none",
-    )
-
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        tokenizer=tokenizer,
-        data_collator=data_collator,
-    )
-
-    outputs = trainer.predict(tokenized_ds)
-    logits = outputs.predictions
-    labels = outputs.label_ids
-    probs = torch.softmax(torch.tensor(logits), dim=1).numpy()
-    preds = np.argmax(logits, axis=1)
+    probs, texts_per_sec = score(args.model_dir, df, args)
+    preds = probs.argmax(axis=1)
+    labels = df["label"].to_numpy()
 
     metrics = macro_f1(preds, labels)
     metrics["accuracy"] = accuracy_score(labels, preds)
+    metrics["texts_per_sec"] = texts_per_sec
     print("Evaluation metrics:", metrics)
 
+    if args.teacher_dir:
+        teacher_probs, teacher_speed = score(args.teacher_dir, df, args)
+        teacher_preds = teacher_probs.argmax(axis=1)
+        teacher_metrics = macro_f1(teacher_preds, labels)
+        teacher_metrics["accuracy"] = accuracy_score(labels, teacher_preds)
+        teacher_metrics["texts_per_sec"] = teacher_speed
+        print("Teacher metrics:", teacher_metrics)
+        print(
+            "Student vs teacher: "
+            f"macro_f1 {metrics['macro_f1']:.4f} vs {teacher_metrics['macro_f1']:.4f}, "
+            f"texts/sec {texts_per_sec:.1f} vs {teacher_speed:.1f} "
+            f"({texts_per_sec / teacher_speed:.2f}x), "
+            f"label agreement {np.mean(preds == teacher_preds):.4f}"
+        )
+
+    if args.fast_model:
+        fast_probs = FastClassifier.load(args.fast_model).predict_proba(df["text"].tolist())
+        thresholds = [float(t) for t in args.thresholds.split(",") if t.strip()]
+        best = sweep_cascade(fast_probs, probs, labels, thresholds, args.max_f1_loss)
+        if best is None:
+            print(f"No threshold keeps the macro-F1 loss within {args.max_f1_loss}")
+        else:
+            print(f"Suggested SENTIMENT_CASCADE_THRESHOLD={best}")
+
     target_names = ["negative", "neutral", "positive"]
     report = classification_report(labels, preds, target_names=target_names, digits=4)
     print("\nClassification report:\n", report)
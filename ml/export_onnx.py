@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from sentiment_engine import SentimentEngine
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export the classifier to ONNX (fp32 + dynamic int8) and check parity")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to trained model directory")
+    parser.add_argument("--output_dir", type=str, default=None, help="Defaults to <model_dir>/onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--parity_path", type=str, default=None, help="Held-out CSV with a 'text' column for the parity check")
+    parser.add_argument("--parity_rows", type=int, default=2000, help="Rows of the parity CSV to score (0 = all)")
+    parser.add_argument("--max_length", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=0, help="torch/onnxruntime intra-op threads, 0 keeps the default")
+    parser.add_argument("--min_agreement", type=float, default=0.99, help="Minimum label agreement with torch fp32")
+    parser.add_argument("--max_drift", type=float, default=0.05, help="Maximum absolute probability drift vs torch fp32")
+    return parser.parse_args()
+
+
+def export(model_dir: str, onnx_path: str, opset: int) -> None:
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+    # Return a plain logits tensor instead of a ModelOutput
+    model.config.return_dict = False
+
+    sample = tokenizer(["пример отзыва", "ещё один текст подлиннее"], padding=True, return_tensors="pt")
+    input_names = list(sample.keys())
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            # A trailing dict is passed as keyword arguments
+            ({name: sample[name] for name in input_names},),
+            onnx_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    print("ONNX graph saved to", onnx_path)
+
+
+def quantize(onnx_path: str, int8_path: str) -> None:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QInt8)
+    print("Dynamic int8 graph saved to", int8_path)
+
+
+def parity_check(args: argparse.Namespace, variants: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Scores the held-out texts with torch fp32 and every variant and compares
+    labels, probabilities and throughput against the fp32 reference.
+    """
+    df = pd.read_csv(args.parity_path)
+    if "text" not in df.columns:
+        raise ValueError("Parity CSV must contain a 'text' column")
+    texts = df["text"].dropna().astype(str).tolist()
+    if args.parity_rows:
+        texts = texts[: args.parity_rows]
+
+    def score(**engine_kwargs):
+        engine = SentimentEngine(
+            args.model_dir,
+            device="cpu",
+            threads=args.threads,
+            max_length=args.max_length,
+            **engine_kwargs,
+        )
+        engine.predict_proba(texts[:32])  # warm-up
+        start = time.perf_counter()
+        probs = engine.predict_proba(texts)
+        return probs, len(texts) / (time.perf_counter() - start)
+
+    reference, reference_speed = score(backend="torch")
+    report = {"torch": {"texts_per_sec": reference_speed}}
+    for name, engine_kwargs in variants.items():
+        probs, speed = score(**engine_kwargs)
+        agreement = float(np.mean(probs.argmax(axis=1) == reference.argmax(axis=1)))
+        drift = float(np.abs(probs - reference).max()) if len(probs) else 0.0
+        report[name] = {
+            "label_agreement": agreement,
+            "max_prob_drift": drift,
+            "texts_per_sec": speed,
+            "speedup": speed / reference_speed,
+            "passed": agreement >= args.min_agreement and drift <= args.max_drift,
+        }
+    return report
+
+
+def main() -> None:
+    args = parse_args()
+    output_dir = args.output_dir or os.path.join(args.model_dir, "onnx")
+    os.makedirs(output_dir, exist_ok=True)
+    onnx_path = os.path.join(output_dir, "model.onnx")
+    int8_path = os.path.join(output_dir, "model.int8.onnx")
+
+    export(args.model_dir, onnx_path, args.opset)
+    quantize(onnx_path, int8_path)
+
+    if not args.parity_path:
+        print("No --parity_path given, skipping the parity check")
+        return
+
+    report = parity_check(
+        args,
+        {
+            "torch-int8": {"backend": "torch-int8"},
+            "onnxruntime": {"backend": "onnxruntime", "onnx_path": onnx_path},
+            "onnxruntime-int8": {"backend": "onnxruntime", "onnx_path": int8_path},
+        },
+    )
+    for name, stats in report.items():
+        print(name, stats)
+
+    report_path = os.path.join(output_dir, "parity.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Parity report saved to", report_path)
+
+    failed = [name for name, stats in report.items() if not stats.get("passed", True)]
+    if failed:
+        raise SystemExit(f"Parity check failed for: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+from typing import Iterable, List
+
+import joblib
+import numpy as np
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import make_pipeline, make_union
+
+from preprocess import batch_clean_text
+
+
+class FastClassifier:
+    """
+    Hashed word + character n-gram linear classifier used as the cheap first
+    tier of the sentiment cascade. Hashing keeps it vocabulary-free, and the
+    SGD model is wrapped in sigmoid calibration so `predict_proba` can be
+    gated by a confidence threshold.
+    """
+
+    def __init__(self, pipeline) -> None:
+        self.pipeline = pipeline
+
+    @classmethod
+    def train(
+        cls,
+        texts: Iterable[str],
+        labels: Iterable[int],
+        n_features: int = 2**20,
+        alpha: float = 1e-5,
+        seed: int = 42,
+    ) -> "FastClassifier":
+        features = make_union(
+            HashingVectorizer(
+                analyzer="word", ngram_range=(1, 2), n_features=n_features, alternate_sign=False
+            ),
+            HashingVectorizer(
+                analyzer="char_wb", ngram_range=(2, 5), n_features=n_features, alternate_sign=False
+            ),
+        )
+        model = CalibratedClassifierCV(
+            SGDClassifier(loss="log_loss", alpha=alpha, class_weight="balanced", random_state=seed),
+            method="sigmoid",
+            cv=3,
+        )
+        pipeline = make_pipeline(features, model)
+        pipeline.fit(batch_clean_text(list(texts)), np.asarray(list(labels), dtype=np.int64))
+        return cls(pipeline)
+
+    @classmethod
+    def load(cls, path: str) -> "FastClassifier":
+        return cls(joblib.load(path))
+
+    def save(self, path: str) -> None:
+        joblib.dump(self.pipeline, path)
+
+    def predict_proba(self, texts: List[str], num_labels: int = 3) -> np.ndarray:
+        probs = np.zeros((len(texts), num_labels), dtype=np.float32)
+        if texts:
+            probs[:, self.pipeline.classes_] = self.pipeline.predict_proba(batch_clean_text(texts))
+        return probs
@@ -1,19 +1,12 @@
 import argparse
+from collections import deque
 from pathlib import Path
+from typing import Deque, Iterator
 
 import numpy as np
 import pandas as pd
-import torch
-from datasets import Dataset
-from transformers import (
-    AutoModelForSequenceClassification,
-    AutoTokenizer,
-    DataCollatorWithPadding,
-    Trainer,
-    TrainingArguments,
-)
 
-from preprocess import batch_clean_text
+from sentiment_engine import BACKENDS, SentimentEngine
 
 
 def parse_args() -> argparse.Namespace:
@@ -23,67 +16,73 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--submission_path", type=str, default="submission.csv")
     parser.add_argument("--probs_path", type=str, default="test_probs.csv", help="Where to save per-class probabilities")
     parser.add_argument("--max_length", type=int, default=256)
-    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--token_budget", type=int, default=8192, help="Max padded tokens per forward pass")
+    parser.add_argument("--backend", type=str, default="torch", choices=BACKENDS)
+    parser.add_argument("--device", type=str, default=None, help="Defaults to cuda when available")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("--stream", action="store_true", help="Read the CSV in chunks and append results as they are ready")
+    parser.add_argument("--chunk_size", type=int, default=4096, help="Rows per chunk (read, tokenized and scored together)")
     return parser.parse_args()
 
 
-def main() -> None:
-    args = parse_args()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    df = pd.read_csv(args.test_path)
-    if "text" not in df.columns:
-        raise ValueError("test.csv must contain a 'text' column")
+def write_outputs(ids, probs: np.ndarray, submission_path: str, probs_path: str, append: bool = False) -> None:
+    mode, header = ("a", False) if append else ("w", True)
+    submission = pd.DataFrame({"ID": ids, "label": probs.argmax(axis=1)})
+    submission.to_csv(submission_path, index=False, mode=mode, header=header)
 
-    df["text"] = batch_clean_text(df["text"].tolist())
+    probs_df = pd.DataFrame({"ID": ids})
+    for i in range(probs.shape[1]):
+        probs_df[f"prob_{i}"] = probs[:, i]
+    probs_df.to_csv(probs_path, index=False, mode=mode, header=header)
 
-    dataset = Dataset.from_pandas(df.reset_index(drop=True))
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_dir, use_fast=True)
-    model = AutoModelForSequenceClassification.from_pretrained(args.model_dir).to(device)
+def stream_predict(engine: SentimentEngine, args: argparse.Namespace) -> int:
+    """
+    Scores the CSV chunk by chunk and appends every chunk to the outputs,
+    so memory stays constant in the number of rows. Returns the row count.
+    """
+    pending_ids: Deque[np.ndarray] = deque()
 
-    def tokenize_function(examples):
-        return tokenizer(
-            examples["text"],
-            padding="max_length",
-            truncation=True,
-            max_length=args.max_length,
-        )
+    def texts() -> Iterator[str]:
+        for chunk in pd.read_csv(args.test_path, chunksize=args.chunk_size):
+            if "text" not in chunk.columns:
+                raise ValueError("test.csv must contain a 'text' column")
+            pending_ids.append(chunk["ID"].to_numpy())
+            yield from chunk["text"].tolist()
 
-    remove_cols = [c for c in dataset.column_names if c != "ID"]
-    tokenized_ds = dataset.map(tokenize_function, batched=True, remove_columns=remove_cols)
-    tokenized_ds.set_format(type="torch")
+    rows = 0
+    for probs in engine.iter_predict_proba(texts()):
+        # Engine chunks and CSV chunks have the same size, so they line up
+        ids = pending_ids.popleft()
+        write_outputs(ids, probs, args.submission_path, args.probs_path, append=rows > 0)
+        rows += len(probs)
+        print(f"Scored {rows} rows")
+    return rows
 
-    data_collator = DataCollatorWithPadding(tokenizer=tokenizer, pad_to_multiple_of=8)
 
-    training_args = TrainingArguments(
-        output_dir="inference_tmp",
-        per_device_eval_batch_size=args.batch_size,
-        report_to="none",
-    )
+def main() -> None:
+    args = parse_args()
+    Path(args.probs_path).parent.mkdir(parents=True, exist_ok=True)
 
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        tokenizer=tokenizer,
-        data_collator=data_collator,
+    engine = SentimentEngine(
+        args.model_dir,
+        backend=args.backend,
+        device=args.device,
+        threads=args.threads,
+        token_budget=args.token_budget,
+        max_length=args.max_length,
+        chunk_size=args.chunk_size,
     )
 
-    outputs = trainer.predict(tokenized_ds)
-    logits = outputs.predictions
-    probs = torch.softmax(torch.tensor(logits), dim=1).numpy()
-    preds = np.argmax(logits, axis=1)
+    if args.stream:
+        stream_predict(engine, args)
+    else:
+        df = pd.read_csv(args.test_path)
+        if "text" not in df.columns:
+            raise ValueError("test.csv must contain a 'text' column")
+        write_outputs(df["ID"], engine.predict_proba(df), args.submission_path, args.probs_path)
 
-    submission = pd.DataFrame({"ID": df["ID"], "label": preds})
-    submission.to_csv(args.submission_path, index=False)
     print("Submission saved to", args.submission_path)
-
-    prob_cols = [f"prob_{i}" for i in range(probs.shape[1])]
-    probs_df = pd.DataFrame({"ID": df["ID"]})
-    for i, col in enumerate(prob_cols):
-        probs_df[col] = probs[:, i]
-    Path(args.probs_path).parent.mkdir(parents=True, exist_ok=True)
-    probs_df.to_csv(args.probs_path, index=False)
     print("Per-class probabilities saved to", args.probs_path)
 
 
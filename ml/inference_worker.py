@@ -1,28 +1,114 @@
+import copy
+import functools
+import gc
+import gzip
 import html
 import io
 import json
+import multiprocessing
 import os
+import pickle
 import random
 import re
-from typing import List, Tuple
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import torch
 import umap
+from umap.umap_ import nearest_neighbors
 from bertopic import BERTopic
 from celery import Celery
+from celery.signals import task_postrun, worker_init, worker_process_init
 from sentence_transformers import SentenceTransformer
+from sklearn.decomposition import PCA
+from sklearn.neighbors import NearestNeighbors
 from transformers import (
     AutoModelForCausalLM,
-    AutoModelForSequenceClassification,
     AutoTokenizer,
+    DynamicCache,
 )
 
+from dedup import near_duplicate_groups
+from embedding_cache import EmbeddingCache
+from model_registry import ModelRegistry
+from prediction_cache import PredictionCache
+from sentiment_engine import SentimentEngine, length_buckets
+from summary_cache import SummaryCache
+from utils.instrumentation import Metrics, reset_peak_rss
+
 # Configuration
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MAX_CLUSTERS = 3
+# 2D map projection: "umap", "pca" (PCA + kNN smoothing) or "auto" (pca for large categories)
+PROJECTION_MODE = os.environ.get("PROJECTION_MODE", "auto")
+PCA_PROJECTION_MIN_ROWS = int(os.environ.get("PCA_PROJECTION_MIN_ROWS", "50000"))
+# Fitted per-category models of finished analyses are kept here for
+# worker.append_reviews; empty disables persistence
+ANALYSIS_STORE_DIR = os.environ.get("ANALYSIS_STORE_DIR", "")
+# Share of HDBSCAN outliers in an appended batch above which the category needs a refit
+REFIT_OUTLIER_RATE = float(os.environ.get("REFIT_OUTLIER_RATE", "0.5"))
+# Number of processes clustering `src` categories in parallel (1 = sequential)
+CATEGORY_WORKERS = int(os.environ.get("CATEGORY_WORKERS", "1"))
+# Exact and near-duplicate reviews of a category are embedded and clustered once
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") == "1"
+# Estimated Jaccard similarity of character shingles above which reviews are merged
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.9"))
+# Spread of duplicates around their representative, as a share of the map's std
+DEDUP_JITTER = float(os.environ.get("DEDUP_JITTER", "0.01"))
 MODEL_DIR = "checkpoints"
 GEN_MODEL_NAME = "Qwen/Qwen3-8B"  # Target generation model
+EMBEDDING_MODEL_NAME = "cointegrated/rubert-tiny2"
+# Model residency: RAM budget (0 = unlimited), idle eviction (0 = never) and
+# models loaded eagerly when a worker process starts
+MODEL_RAM_BUDGET_MB = int(os.environ.get("MODEL_RAM_BUDGET_MB", "0"))
+MODEL_IDLE_TIMEOUT_S = float(os.environ.get("MODEL_IDLE_TIMEOUT_S", "0"))
+HOT_MODELS = [
+    name.strip()
+    for name in os.environ.get("HOT_MODELS", "embedding,classifier").split(",")
+    if name.strip()
+]
+# Load the read-only models in the Celery parent before the prefork pool
+# forks, so children share their pages copy-on-write
+PRELOAD_IN_PARENT = os.environ.get("PRELOAD_IN_PARENT", "0") == "1"
+SHARED_MODELS = ["embedding", "classifier"]
+# Intra-op threads per worker process (0 = torch default)
+WORKER_TORCH_THREADS = int(os.environ.get("WORKER_TORCH_THREADS", "0"))
+# Empty EMBEDDING_CACHE_DIR disables the on-disk embedding cache
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "embedding_cache")
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", "2048"))
+CSV_CHUNK_SIZE = int(os.environ.get("CSV_CHUNK_SIZE", "10000"))
+# Uploads can be handed over as a path on a volume shared with the backend
+SHARED_DATA_DIR = os.environ.get("SHARED_DATA_DIR", ".")
+CSV_COLUMNS = {"text": str, "src": str, "ID": str}
+# Large results are written here instead of the Celery result backend
+RESULT_STORE_DIR = os.environ.get("RESULT_STORE_DIR", "results")
+# Publish each category's results to a Redis stream as soon as it is finished
+RESULT_STREAM = os.environ.get("RESULT_STREAM", "0") == "1"
+RESULT_STREAM_TTL_S = int(os.environ.get("RESULT_STREAM_TTL_S", "86400"))
+GEN_MAX_NEW_TOKENS = 256
+# Reuse the KV cache of the shared system-prompt prefix across summary requests
+GEN_PREFIX_CACHE = os.environ.get("GEN_PREFIX_CACHE", "1") == "1"
+# Upper bound on (prompt + new tokens) * rows per summarization generate() call
+GEN_BATCH_TOKEN_BUDGET = int(os.environ.get("GEN_BATCH_TOKEN_BUDGET", "16384"))
+# Empty SUMMARY_CACHE_PATH disables memoization of cluster summaries
+SUMMARY_CACHE_PATH = os.environ.get("SUMMARY_CACHE_PATH", "summary_cache.sqlite3")
+SUMMARY_CACHE_TTL_HOURS = float(os.environ.get("SUMMARY_CACHE_TTL_HOURS", "720"))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", "100000"))
+SENTIMENT_MAX_LENGTH = 256
+# Upper bound on padded tokens (rows * longest row) per classifier forward pass
+SENTIMENT_TOKEN_BUDGET = int(os.environ.get("SENTIMENT_TOKEN_BUDGET", "8192"))
+# torch, torch-int8 or onnxruntime (see export_onnx.py)
+SENTIMENT_BACKEND = os.environ.get("SENTIMENT_BACKEND", "torch")
+SENTIMENT_ONNX_PATH = os.environ.get("SENTIMENT_ONNX_PATH") or None
+SENTIMENT_FAST_MODEL = os.environ.get("SENTIMENT_FAST_MODEL") or None
+SENTIMENT_CASCADE_THRESHOLD = float(os.environ.get("SENTIMENT_CASCADE_THRESHOLD", "0.9"))
+# Sentiment predictions memoized by text hash; 0 disables, an empty Redis URL keeps it in-process
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "100000"))
+PREDICTION_CACHE_REDIS_URL = os.environ.get("PREDICTION_CACHE_REDIS_URL", "")
+PREDICTION_CACHE_TTL_S = int(os.environ.get("PREDICTION_CACHE_TTL_S", str(7 * 24 * 3600)))
 
 # Celery Setup
 app = Celery(
@@ -38,52 +124,146 @@ app.conf.update(
     enable_utc=True,
 )
 
+# Stage timings and counters of the task currently running in this process
+metrics = Metrics("worker")
+
 SENTIMENT_MAP = {0: "negative", 1: "neutral", 2: "positive"}
+SENTIMENT_LABELS = np.array([SENTIMENT_MAP[i] for i in range(len(SENTIMENT_MAP))], dtype=object)
+REVIEW_COLUMNS = ["source_id", "text", "sentiment", "confidence", "cluster_id", "x", "y"]
+
+# Global caches
+_EMBEDDING_CACHE = None
+_GEN_PREFIX = None
+_SUMMARY_CACHE = None
+prediction_cache = (
+    PredictionCache(
+        PREDICTION_CACHE_SIZE,
+        redis_url=PREDICTION_CACHE_REDIS_URL or None,
+        ttl_seconds=PREDICTION_CACHE_TTL_S,
+    )
+    if PREDICTION_CACHE_SIZE > 0
+    else None
+)
+
+
+def _load_embedding_model():
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def _load_classifier_model():
+    return SentimentEngine(
+        MODEL_DIR,
+        backend=SENTIMENT_BACKEND,
+        device="cpu" if SENTIMENT_BACKEND == "torch-int8" else device,
+        onnx_path=SENTIMENT_ONNX_PATH,
+        fast_model_path=SENTIMENT_FAST_MODEL,
+        cascade_threshold=SENTIMENT_CASCADE_THRESHOLD,
+        token_budget=SENTIMENT_TOKEN_BUDGET,
+        max_length=SENTIMENT_MAX_LENGTH,
+        metrics=metrics,
+        metrics_prefix="sentiment_",
+        cache=prediction_cache,
+    )
 
-# Global caches for models
-_EMBEDDING_MODEL = None
-_CLASSIFIER_MODEL = None
-_CLASSIFIER_TOKENIZER = None
-_GEN_MODEL = None
-_GEN_TOKENIZER = None
+
+def _load_generation_model():
+    print(f"Loading generation model: {GEN_MODEL_NAME}...")
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(GEN_MODEL_NAME, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(
+            GEN_MODEL_NAME,
+            device_map="auto",  # Automatically handles multi-gpu or cpu offload
+            torch_dtype=torch.bfloat16,  # Use half-precision for memory efficiency
+            trust_remote_code=True,
+        )
+    except Exception as e:
+        print(f"Error loading generation model: {e}")
+        raise e
+    return model, tokenizer
+
+
+def _reset_summary_prefix():
+    global _GEN_PREFIX
+    _GEN_PREFIX = None
+
+
+models = ModelRegistry(
+    budget_bytes=MODEL_RAM_BUDGET_MB * 1024 * 1024,
+    idle_timeout=MODEL_IDLE_TIMEOUT_S,
+)
+models.register("embedding", _load_embedding_model, hot="embedding" in HOT_MODELS)
+models.register("classifier", _load_classifier_model, hot="classifier" in HOT_MODELS)
+models.register(
+    "generation",
+    _load_generation_model,
+    hot="generation" in HOT_MODELS,
+    on_evict=_reset_summary_prefix,
+)
+
+
+@worker_init.connect
+def preload_shared_models(**_):
+    """Runs once in the parent process, before the prefork pool starts."""
+    if not PRELOAD_IN_PARENT:
+        return
+    models.preload(SHARED_MODELS)
+    models.pin(SHARED_MODELS)
+    # Keep the garbage collector from writing to the preloaded objects'
+    # headers in the children, which would un-share their pages
+    gc.collect()
+    gc.freeze()
+
+
+@worker_process_init.connect
+def preload_hot_models(**_):
+    if WORKER_TORCH_THREADS:
+        torch.set_num_threads(WORKER_TORCH_THREADS)
+    models.preload(models.hot_models())
+    if PRELOAD_IN_PARENT:
+        # One tiny forward per child so the first real task runs at steady-state speed
+        get_embedding_model().encode(["прогрев"], show_progress_bar=False)
+        # Not predict_sentiment: a prediction cache hit would skip the model
+        get_classifier_model().warm_up(["прогрев"])
+
+
+@task_postrun.connect
+def evict_idle_models(**_):
+    models.evict_idle()
 
 
 def get_embedding_model():
-    global _EMBEDDING_MODEL
-    if _EMBEDDING_MODEL is None:
-        _EMBEDDING_MODEL = SentenceTransformer("cointegrated/rubert-tiny2")
-    return _EMBEDDING_MODEL
+    return models.get("embedding")
+
+
+def get_embedding_cache():
+    global _EMBEDDING_CACHE
+    if _EMBEDDING_CACHE is None and EMBEDDING_CACHE_DIR:
+        _EMBEDDING_CACHE = EmbeddingCache(
+            EMBEDDING_CACHE_DIR,
+            EMBEDDING_MODEL_NAME,
+            max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+        )
+    return _EMBEDDING_CACHE
+
+
+def get_summary_cache():
+    global _SUMMARY_CACHE
+    if _SUMMARY_CACHE is None and SUMMARY_CACHE_PATH:
+        _SUMMARY_CACHE = SummaryCache(
+            SUMMARY_CACHE_PATH,
+            ttl_seconds=SUMMARY_CACHE_TTL_HOURS * 3600,
+            max_entries=SUMMARY_CACHE_MAX_ENTRIES,
+        )
+    return _SUMMARY_CACHE
 
 
 def get_classifier_model():
-    global _CLASSIFIER_MODEL, _CLASSIFIER_TOKENIZER
-    if _CLASSIFIER_MODEL is None or _CLASSIFIER_TOKENIZER is None:
-        _CLASSIFIER_TOKENIZER = AutoTokenizer.from_pretrained(MODEL_DIR, use_fast=True)
-        _CLASSIFIER_MODEL = AutoModelForSequenceClassification.from_pretrained(
-            MODEL_DIR
-        ).to(device)
-    return _CLASSIFIER_MODEL, _CLASSIFIER_TOKENIZER
+    return models.get("classifier")
 
 
 def get_generation_model() -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
     """Lazy loads the Qwen model for summarization."""
-    global _GEN_MODEL, _GEN_TOKENIZER
-    if _GEN_MODEL is None or _GEN_TOKENIZER is None:
-        print(f"Loading generation model: {GEN_MODEL_NAME}...")
-        try:
-            _GEN_TOKENIZER = AutoTokenizer.from_pretrained(
-                GEN_MODEL_NAME, trust_remote_code=True
-            )
-            _GEN_MODEL = AutoModelForCausalLM.from_pretrained(
-                GEN_MODEL_NAME,
-                device_map="auto",  # Automatically handles multi-gpu or cpu offload
-                torch_dtype=torch.bfloat16,  # Use half-precision for memory efficiency
-                trust_remote_code=True,
-            )
-        except Exception as e:
-            print(f"Error loading generation model: {e}")
-            raise e
-    return _GEN_MODEL, _GEN_TOKENIZER
+    return models.get("generation")
 
 
 def clean_text(text: str) -> str:
@@ -98,230 +278,1240 @@ def batch_clean_text(texts: List[str]) -> List[str]:
     return [clean_text(t) for t in texts]
 
 
-def generate_summary(keywords, documents):
-    """Generates a summary using Qwen instead of OpenAI."""
-    model, tokenizer = get_generation_model()
+class ProgressReporter:
+    """
+    Publishes stage-level progress of a task as Celery PROGRESS state meta:
+    current stage, category index, rows done, per-stage elapsed time and a
+    suggested delay before the next poll. With `streaming`, categories are
+    summarized and classified one by one, so every per-category stage moves
+    through the whole range after embedding.
+    """
+
+    # Share of the overall progress at which each stage starts
+    STAGE_START = {
+        "parse": 0,
+        "embed": 5,
+        "topic-fit": 15,
+        "umap": 15,
+        "summarize": 70,
+        "sentiment": 90,
+    }
+
+    def __init__(self, task, streaming: bool = False) -> None:
+        self.task = task
+        self.streaming = streaming
+        self.started = time.monotonic()
+        self.stage_name: Optional[str] = None
+        self.stage_started = self.started
+        self.stage_elapsed: Dict[str, float] = {}
+        self.total_categories = 0
+        self.rows_total = 0
 
-    system_prompt = (
-        "Ты — аналитик данных. Твоя задача — проанализировать отзывы и ключевые слова кластера. "
-        "Создай JSON с полями 'title' (краткий заголовок 3-5 слов) и 'description' (описание 1 предложение). "
-        "НЕ пиши вводных слов, верни ТОЛЬКО валидный JSON."
+    def stage(
+        self,
+        name: str,
+        category_index: int = 0,
+        rows_done: int = 0,
+    ) -> None:
+        now = time.monotonic()
+        if self.stage_name is not None:
+            self.stage_elapsed[self.stage_name] = (
+                self.stage_elapsed.get(self.stage_name, 0.0) + now - self.stage_started
+            )
+        self.stage_name = name
+        self.stage_started = now
+
+        percent = self.STAGE_START[name]
+        if self.streaming and name != "parse" and name != "embed" and self.total_categories:
+            percent = 15 + min(84, int(85 * category_index / self.total_categories))
+        elif name in ("topic-fit", "umap") and self.total_categories:
+            percent += int(55 * category_index / self.total_categories)
+        elapsed = now - self.started
+        meta = {
+            "stage": name,
+            "percent": percent,
+            "category_index": category_index,
+            "total_categories": self.total_categories,
+            "rows_done": rows_done,
+            "rows_total": self.rows_total,
+            "elapsed": elapsed,
+            "stage_elapsed": dict(self.stage_elapsed),
+            # Long analyses move slowly, so clients can poll less often as time goes on
+            "poll_after": min(30.0, max(1.0, 0.1 * elapsed)),
+        }
+        print("progress:", meta)
+        if self.task.request.id is not None:
+            self.task.update_state(state="PROGRESS", meta=meta)
+
+
+def open_csv_source(csv_data: str):
+    """
+    Resolves the task payload to something `pd.read_csv` can stream from:
+    a `file://` reference to a file inside SHARED_DATA_DIR, otherwise the raw
+    CSV text. Raises ValueError for references outside the shared volume.
+    """
+    if not csv_data.startswith("file://"):
+        return io.StringIO(csv_data)
+    shared_dir = os.path.realpath(SHARED_DATA_DIR)
+    path = os.path.realpath(os.path.join(shared_dir, csv_data[len("file://") :]))
+    if os.path.commonpath([shared_dir, path]) != shared_dir:
+        raise ValueError(f"Upload path outside SHARED_DATA_DIR: {csv_data}")
+    return path
+
+
+def read_reviews_by_source(source, chunksize: int = CSV_CHUNK_SIZE) -> Dict[str, pd.DataFrame]:
+    """
+    Streams the CSV in chunks, keeping only the `text`/`src`/`ID` columns,
+    and groups rows by `src` in order of first appearance. Each row keeps
+    its position in the file in a `row` column.
+    Raises KeyError if `text` or `src` is missing.
+    """
+    groups: Dict[str, List[pd.DataFrame]] = {}
+    reader = pd.read_csv(
+        source,
+        usecols=lambda column: column in CSV_COLUMNS,
+        dtype=CSV_COLUMNS,
+        chunksize=chunksize,
     )
+    for chunk in reader:
+        if "text" not in chunk.columns or "src" not in chunk.columns:
+            raise KeyError("text/src")
+        chunk = chunk.dropna(subset=["text"])
+        # Data row number in the uploaded CSV, so results can be joined back to it
+        chunk["row"] = chunk.index
+        for category, part in chunk.groupby("src", sort=False):
+            groups.setdefault(category, []).append(part)
+    return {
+        category: pd.concat(parts, ignore_index=True)
+        for category, parts in groups.items()
+    }
+
+
+@metrics.timer("embed")
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Embeds cleaned texts, reusing cached vectors and encoding only the misses
+    in a single call (SentenceTransformer sorts them by length internally).
+    """
+    cache = get_embedding_cache()
+    if cache is None:
+        metrics.inc("embedded_rows", len(texts))
+        return get_embedding_model().encode(texts, show_progress_bar=False)
+
+    found, missing = cache.lookup(texts)
+    metrics.inc("embedding_cache_hits", len(found))
+    metrics.inc("embedded_rows", len(missing))
+    if missing:
+        encoded = get_embedding_model().encode(
+            [texts[i] for i in missing], show_progress_bar=False
+        )
+        cache.add([texts[i] for i in missing], encoded)
+        found.update(zip(missing, encoded))
+    else:
+        cache.flush()
+    print("embedding cache:", cache.stats())
+    return np.stack([found[i] for i in range(len(texts))]).astype(np.float32)
+
+
+@metrics.timer("sentiment")
+def predict_sentiment(texts: List[str]) -> Tuple[List[int], List[float]]:
+    """Classifies texts and returns labels and confidences in the original order."""
+    labels, confidences = get_classifier_model().predict(texts)
+    return labels.tolist(), confidences.tolist()
 
-    user_prompt = f"""
-    Ключевые слова: {", ".join(keywords)}
-    Примеры отзывов: {json.dumps(documents, ensure_ascii=False)}
+
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты — аналитик данных. Твоя задача — проанализировать отзывы и ключевые слова кластера. "
+    "Создай JSON с полями 'title' (краткий заголовок 3-5 слов) и 'description' (описание 1 предложение). "
+    "НЕ пиши вводных слов, верни ТОЛЬКО валидный JSON."
+)
+
+SUMMARY_USER_TEMPLATE = """
+    Ключевые слова: {keywords}
+    Примеры отзывов: {documents}
 
     Сформируй JSON в формате: {{"title": "...", "description": "..."}}
     """
 
-    messages = [
-        {"role": "system", "content": system_prompt},
+FORMAT_ERROR_SUMMARY = {
+    "title": "Ошибка формата",
+    "description": "Модель вернула некорректный ответ.",
+}
+GENERATION_ERROR_SUMMARY = {
+    "title": "Ошибка генерации",
+    "description": "Не удалось получить ответ от AI",
+}
+
+
+def build_summary_messages(keywords, documents) -> List[dict]:
+    user_prompt = SUMMARY_USER_TEMPLATE.format(
+        keywords=", ".join(keywords),
+        documents=json.dumps(documents, ensure_ascii=False),
+    )
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
         {"role": "user", "content": user_prompt},
     ]
 
-    try:
-        # Format input using the chat template
-        text_input = tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        model_inputs = tokenizer([text_input], return_tensors="pt").to(model.device)
-
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **model_inputs,
-                max_new_tokens=256,
-                temperature=0.3,
-                top_p=0.9,
-                do_sample=True,
-            )
 
-        # Decode output
-        generated_ids = [
-            output_ids[len(input_ids) :]
-            for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        response_text = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[
-            0
-        ]
-
-        # Extract JSON using regex in case the model adds conversational filler
-        json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
-        if json_match:
+def parse_summary(response_text: str) -> dict:
+    # Extract JSON using regex in case the model adds conversational filler
+    json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
+    if json_match:
+        try:
             return json.loads(json_match.group(0))
-        else:
-            print(f"Failed to parse JSON from Qwen response: {response_text}")
-            return {
-                "title": "Ошибка формата",
-                "description": "Модель вернула некорректный ответ.",
-            }
+        except json.JSONDecodeError:
+            pass
+    print(f"Failed to parse JSON from Qwen response: {response_text}")
+    return dict(FORMAT_ERROR_SUMMARY)
 
-    except Exception as e:
-        print(f"Generation Error: {e}")
-        return {
-            "title": "Ошибка генерации",
-            "description": "Не удалось получить ответ от AI",
-        }
 
+def get_summary_prefix():
+    """
+    Prefills the chat-template prefix shared by every summary prompt (system
+    prompt up to the start of the user turn) once per loaded generation model.
+    Returns (prefix text, prefix input ids, KV cache).
+    """
+    global _GEN_PREFIX
+    model, tokenizer = get_generation_model()
+    if _GEN_PREFIX is None:
+        marker = "<<cluster>>"
+        rendered = tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": marker},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        prefix_text = rendered[: rendered.index(marker)]
+        prefix_ids = tokenizer(
+            prefix_text, return_tensors="pt", add_special_tokens=False
+        ).input_ids.to(model.device)
 
-@app.task(bind=True, name="worker.process_file")
-def run_clustering_task(self, csv_data: str, task_arg_id: str):
-    try:
-        df = pd.read_csv(io.StringIO(csv_data))[:500]
-    except FileNotFoundError:
-        return {"status": "error", "message": "Не удалось прочитать файл"}
+        prefix_cache = DynamicCache()
+        with torch.inference_mode():
+            model(input_ids=prefix_ids, past_key_values=prefix_cache, use_cache=True)
+        _GEN_PREFIX = (prefix_text, prefix_ids, prefix_cache)
+    return _GEN_PREFIX
 
-    if "text" not in df.columns or "src" not in df.columns:
-        return {"status": "error", "message": "В CSV нет колонок text или src"}
 
-    embedding_model = get_embedding_model()
+def build_generate_inputs(model, tokenizer, prompts: List[str]) -> dict:
+    """
+    Builds generate() inputs for a batch of summary prompts. With the prefix
+    cache enabled only the per-cluster suffixes are prefilled: they are left
+    padded, so the padding sits between the cached prefix and the suffix and
+    is masked out by the attention mask.
+    """
+    prefix = get_summary_prefix() if GEN_PREFIX_CACHE else None
+    if prefix is None or not all(p.startswith(prefix[0]) for p in prompts):
+        return dict(tokenizer(prompts, return_tensors="pt", padding=True).to(model.device))
 
-    result_frames = []
-    cluster_summaries = []
-    topic_offset = 0
+    prefix_text, prefix_ids, prefix_cache = prefix
+    suffixes = tokenizer(
+        [p[len(prefix_text) :] for p in prompts],
+        return_tensors="pt",
+        padding=True,
+        add_special_tokens=False,
+    ).to(model.device)
 
-    categories = df["src"].unique()
-    total_cats = len(categories)
+    batch_size = len(prompts)
+    past_key_values = copy.deepcopy(prefix_cache)
+    past_key_values.batch_repeat_interleave(batch_size)
+    prefix_ids = prefix_ids.expand(batch_size, -1)
+    return {
+        "input_ids": torch.cat([prefix_ids, suffixes.input_ids], dim=1),
+        "attention_mask": torch.cat(
+            [torch.ones_like(prefix_ids), suffixes.attention_mask], dim=1
+        ),
+        "past_key_values": past_key_values,
+    }
 
-    for idx, category in enumerate(categories):
-        progress_percent = 10 + int((idx / total_cats) * 80)
-        print("processing category:", category, "progress:", progress_percent)
 
-        subset = df[df["src"] == category].copy()
-        texts = subset["text"].tolist()
+def generate_summaries(
+    jobs: List[Tuple[List[str], List[str]]],
+    token_budget: int = GEN_BATCH_TOKEN_BUDGET,
+) -> List[dict]:
+    """
+    Summarizes clusters given as (keywords, documents) pairs.
+    Summaries memoized by the summary cache are returned as is; the model is
+    only loaded when at least one cluster misses.
+    """
+    cache = get_summary_cache()
+    if cache is None:
+        return run_summary_generation(jobs, token_budget)
+
+    template = SUMMARY_SYSTEM_PROMPT + SUMMARY_USER_TEMPLATE
+    keys = [
+        cache.key(GEN_MODEL_NAME, template, keywords, documents)
+        for keywords, documents in jobs
+    ]
+    cached = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+
+    generated = run_summary_generation([jobs[i] for i in missing], token_budget)
+    fresh = {}
+    for i, info in zip(missing, generated):
+        cached[keys[i]] = info
+        if info not in (FORMAT_ERROR_SUMMARY, GENERATION_ERROR_SUMMARY):
+            fresh[keys[i]] = info
+    cache.put_many(fresh)
+    print("summary cache:", cache.stats())
+    return [dict(cached[key]) for key in keys]
 
-        if len(texts) < 5:
-            continue
 
-        embeddings = embedding_model.encode(texts, show_progress_bar=False)
+@metrics.timer("summarize")
+def run_summary_generation(
+    jobs: List[Tuple[List[str], List[str]]],
+    token_budget: int = GEN_BATCH_TOKEN_BUDGET,
+) -> List[dict]:
+    """
+    Generates cluster summaries with Qwen.
+    Prompts are generated in left-padded, length-sorted batches whose
+    prompt + new tokens stay within `token_budget`; every output is
+    decoded and parsed on its own.
+    """
+    if not jobs:
+        return []
+
+    model, tokenizer = get_generation_model()
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
-        topic_model = BERTopic(
-            embedding_model=embedding_model,
-            language="russian",
-            min_topic_size=2,
-            verbose=False,
+    prompts = [
+        tokenizer.apply_chat_template(
+            build_summary_messages(keywords, documents),
+            tokenize=False,
+            add_generation_prompt=True,
         )
-        topics, _ = topic_model.fit_transform(texts, embeddings)
+        for keywords, documents in jobs
+    ]
+    lengths = [
+        len(ids) + GEN_MAX_NEW_TOKENS for ids in tokenizer(prompts)["input_ids"]
+    ]
+
+    results: List[dict] = [dict(GENERATION_ERROR_SUMMARY) for _ in jobs]
+    for bucket in length_buckets(lengths, token_budget):
+        try:
+            with torch.inference_mode():
+                model_inputs = build_generate_inputs(
+                    model, tokenizer, [prompts[i] for i in bucket]
+                )
+                generated_ids = model.generate(
+                    **model_inputs,
+                    max_new_tokens=GEN_MAX_NEW_TOKENS,
+                    temperature=0.3,
+                    top_p=0.9,
+                    do_sample=True,
+                    pad_token_id=tokenizer.pad_token_id,
+                )
+
+            # With left padding every prompt ends at the same position
+            prompt_length = model_inputs["input_ids"].shape[1]
+            new_tokens = generated_ids[:, prompt_length:]
+            responses = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            metrics.inc("summaries", len(bucket))
+            metrics.inc(
+                "generated_tokens", int((new_tokens != tokenizer.pad_token_id).sum())
+            )
+        except Exception as e:
+            print(f"Generation Error: {e}")
+            continue
 
-        freq = topic_model.get_topic_info()
-        real_topics_df = freq[freq["Topic"] != -1]
-        top_topics_df = real_topics_df.head(MAX_CLUSTERS)
-        top_ids = top_topics_df["Topic"].tolist()
+        for i, response_text in zip(bucket, responses):
+            results[i] = parse_summary(response_text)
+    return results
 
-        remap_dict = {old_id: i for i, old_id in enumerate(top_ids)}
 
-        qwen_results = {}
-        for local_id in top_ids:
-            keywords = [w[0] for w in topic_model.get_topic(local_id)[:10]]
-            indices = [i for i, t in enumerate(topics) if t == local_id]
+def generate_summary(keywords, documents):
+    """Generates a summary using Qwen instead of OpenAI."""
+    return generate_summaries([(keywords, documents)])[0]
+
+
+class SmoothedPCA:
+    """
+    PCA projection with every point pulled halfway towards the mean
+    projection of its kNN neighbourhood (the point itself included).
+    The fitted embeddings are kept so `transform` smooths new points
+    against their nearest neighbours on the existing map.
+    """
+
+    def __init__(self) -> None:
+        self.pca = PCA(n_components=2, random_state=42)
+
+    def fit_transform(self, embeddings: np.ndarray, knn_indices: np.ndarray) -> np.ndarray:
+        raw = self.pca.fit_transform(embeddings)
+        self.embeddings = np.asarray(embeddings, dtype=np.float16)
+        self.raw_coords = raw.astype(np.float32)
+        self.n_neighbors = knn_indices.shape[1]
+        return 0.5 * raw + 0.5 * raw[knn_indices].mean(axis=1)
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        raw = self.pca.transform(embeddings)
+        k = min(self.n_neighbors - 1, len(self.embeddings))
+        if k < 1:
+            return raw
+        index = NearestNeighbors(n_neighbors=k, metric="cosine").fit(self.embeddings)
+        neighbours = index.kneighbors(embeddings, return_distance=False)
+        neighbourhood = raw + self.raw_coords[neighbours].sum(axis=1)
+        return 0.5 * raw + 0.5 * neighbourhood / (k + 1)
+
 
-            sample_texts = [
-                texts[i] for i in random.sample(indices, min(len(indices), 15))
+def project_2d(embeddings: np.ndarray, knn, n_neighbors: int):
+    """
+    Projects embeddings onto the 2D map using the category's shared kNN graph.
+    "pca" mode is a cheap alternative for very large categories: a PCA
+    projection with every point pulled towards the mean of its neighbours.
+    Returns the coordinates and the fitted projector.
+    """
+    mode = PROJECTION_MODE
+    if mode == "auto":
+        mode = "pca" if len(embeddings) >= PCA_PROJECTION_MIN_ROWS else "umap"
+
+    if mode == "pca":
+        projector = SmoothedPCA()
+        return projector.fit_transform(embeddings, knn[0]), projector
+
+    reducer = umap.UMAP(
+        n_neighbors=n_neighbors,
+        n_components=2,
+        min_dist=0.1,
+        metric="cosine",
+        random_state=42,
+        precomputed_knn=knn,
+        # umap releases before 0.5.4 ignore precomputed_knn below 4096 rows without this
+        force_approximation_algorithm=True,
+    )
+    return reducer.fit_transform(embeddings), reducer
+
+
+def cluster_category(
+    texts: List[str],
+    embeddings: np.ndarray,
+    embedding_model=None,
+    save_dir: Optional[str] = None,
+    on_stage: Optional[Callable[[str], None]] = None,
+    weights: Optional[np.ndarray] = None,
+) -> dict:
+    """
+    Fits topics and the 2D map for one `src` category.
+    One nearest-neighbour graph is built per category and shared by
+    BERTopic's UMAP reduction and the 2D projection.
+    Returns local topic ids per text plus keywords, example documents and
+    sizes of the top MAX_CLUSTERS topics; global ids are assigned by the caller.
+    With `weights` (reviews behind each text) topics are ranked and sized by
+    the reviews they cover rather than by distinct texts.
+    With `save_dir` the fitted topic model and 2D projector are persisted there.
+    """
+    n_neighbors = 15 if len(texts) > 15 else min(5, len(texts) - 1)
+    if n_neighbors < 2:
+        n_neighbors = 2
+
+    knn = nearest_neighbors(
+        embeddings,
+        n_neighbors=n_neighbors,
+        metric="cosine",
+        metric_kwds={},
+        angular=False,
+        random_state=np.random.RandomState(42),
+    )
+
+    # BERTopic's default reducer settings, fed with the shared kNN graph
+    umap_model = umap.UMAP(
+        n_neighbors=n_neighbors,
+        n_components=5,
+        min_dist=0.0,
+        metric="cosine",
+        low_memory=False,
+        random_state=42,
+        precomputed_knn=knn,
+        # umap releases before 0.5.4 ignore precomputed_knn below 4096 rows without this
+        force_approximation_algorithm=True,
+    )
+    topic_model = BERTopic(
+        embedding_model=embedding_model,
+        umap_model=umap_model,
+        language="russian",
+        min_topic_size=2,
+        verbose=False,
+    )
+    with metrics.timer("topic-fit"):
+        topics, _ = topic_model.fit_transform(texts, embeddings)
+
+    freq = topic_model.get_topic_info()
+    real_topics_df = freq[freq["Topic"] != -1]
+    if weights is not None:
+        sizes = pd.Series(weights).groupby(np.asarray(topics)).sum()
+        real_topics_df = real_topics_df.assign(
+            Count=real_topics_df["Topic"].map(sizes)
+        ).sort_values("Count", ascending=False, kind="stable")
+    top_topics_df = real_topics_df.head(MAX_CLUSTERS)
+    top_ids = top_topics_df["Topic"].tolist()
+
+    keywords, samples = [], []
+    for local_id in top_ids:
+        keywords.append([w[0] for w in topic_model.get_topic(local_id)[:10]])
+        indices = [i for i, t in enumerate(topics) if t == local_id]
+
+        # Seeded so reruns on the same data pick the same examples and hit the summary cache
+        samples.append(
+            [
+                texts[i]
+                for i in random.Random(42).sample(indices, min(len(indices), 15))
             ]
+        )
 
-            # Call the new Qwen-based generator
-            info = generate_summary(keywords, sample_texts)
-            qwen_results[local_id] = info
-            print(f"Cluster {local_id} info: {info}")
-
-            global_id = remap_dict[local_id] + topic_offset
-            count = top_topics_df[top_topics_df["Topic"] == local_id]["Count"].values[0]
-
-            cluster_summaries.append(
-                {
-                    "global_id": global_id,
-                    "category": category,
-                    "title": info.get("title", "No Title"),
-                    "description": info.get("description", "No Description"),
-                    "review_count": int(count),
-                    "keywords": ", ".join(keywords),
-                }
-            )
+    if on_stage is not None:
+        on_stage("umap")
+    with metrics.timer("umap"):
+        coords, projector = project_2d(embeddings, knn, n_neighbors)
 
-        new_global_topics = []
-        titles = []
-
-        for t in topics:
-            if t in remap_dict:
-                new_global_topics.append(remap_dict[t] + topic_offset)
-                titles.append(qwen_results[t]["title"])
-            else:
-                new_global_topics.append(-1)
-                titles.append("Шум")
-
-        subset["cluster_id"] = new_global_topics
-        subset["cluster_title"] = titles
-
-        n_neighbors = 15 if len(texts) > 15 else min(5, len(texts) - 1)
-        if n_neighbors < 2:
-            n_neighbors = 2
-
-        reducer = umap.UMAP(
-            n_neighbors=n_neighbors,
-            n_components=2,
-            min_dist=0.1,
-            metric="cosine",
-            random_state=42,
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+        topic_model.save(
+            os.path.join(save_dir, "topic_model"),
+            serialization="pickle",
+            save_embedding_model=False,
         )
-        coords_2d = reducer.fit_transform(embeddings)
-        subset["x"] = coords_2d[:, 0]
-        subset["y"] = coords_2d[:, 1]
-
-        result_frames.append(subset)
-
-        if len(top_ids) > 0:
-            topic_offset += len(top_ids)
-
-    reviews = []
-    clusters = []
-
-    if result_frames:
-        final_df = pd.concat(result_frames)
-
-        classifier_model, tokenizer = get_classifier_model()
-
-        cleaned = batch_clean_text(final_df["text"].tolist())
-        batch = tokenizer(
-            cleaned,
-            padding=True,
-            truncation=True,
-            max_length=256,
-            return_tensors="pt",
-        ).to(device)
-
-        print("Estimating sentiment...")
-
-        with torch.no_grad():
-            logits = classifier_model(**batch).logits
-            probs = torch.softmax(logits, dim=-1).cpu().tolist()
-            labels = torch.argmax(logits, dim=-1).cpu().tolist()
-
-        final_df["sentiment"] = [SENTIMENT_MAP[label] for label in labels]
-        final_df["confidence"] = [p[label] for p, label in zip(probs, labels)]
-
-        for _, row in final_df.iterrows():
-            reviews.append(
-                {
-                    "source_id": str(row.get("ID", row.get("src", ""))),
-                    "text": row["text"],
-                    "sentiment": row["sentiment"],
-                    "confidence": float(row["confidence"]),
-                    "cluster_id": int(row["cluster_id"]),
-                    "coords": {"x": float(row["x"]), "y": float(row["y"])},
-                }
+        with open(os.path.join(save_dir, "projector.pkl"), "wb") as f:
+            pickle.dump(projector, f)
+
+    return {
+        "topics": list(topics),
+        "top_ids": top_ids,
+        "counts": [int(c) for c in top_topics_df["Count"].tolist()],
+        "keywords": keywords,
+        "samples": samples,
+        "coords": coords,
+    }
+
+
+def assign_category(save_dir: str, texts: List[str], embeddings: np.ndarray):
+    """
+    Assigns new texts of a category to the topics of a persisted analysis and
+    projects them into its existing 2D map, without refitting anything.
+    """
+    topic_model = BERTopic.load(os.path.join(save_dir, "topic_model"))
+    with open(os.path.join(save_dir, "projector.pkl"), "rb") as f:
+        projector = pickle.load(f)
+
+    topics, _ = topic_model.transform(texts, embeddings)
+    return list(topics), projector.transform(embeddings)
+
+
+def collapse_duplicates(subset: pd.DataFrame):
+    """
+    Keeps one review per group of exact or near-duplicates of a category.
+    Returns the representatives with a `weight` column holding their group
+    sizes, and `(representatives, inverse)` positions from
+    `near_duplicate_groups`, or None when nothing was collapsed.
+    """
+    if not DEDUP_ENABLED:
+        return subset, None
+    representatives, inverse = near_duplicate_groups(
+        batch_clean_text(subset["text"].tolist()), threshold=DEDUP_THRESHOLD
+    )
+    # Too few distinct reviews for a neighbour graph: cluster them all as before
+    if len(representatives) == len(subset) or len(representatives) < 5:
+        return subset, None
+    metrics.inc("dedup_collapsed", len(subset) - len(representatives))
+    collapsed = subset.iloc[representatives].copy()
+    collapsed["weight"] = np.bincount(inverse)
+    return collapsed, (representatives, inverse)
+
+
+def expand_duplicates(topics, coords: np.ndarray, duplicate_groups):
+    """
+    Fans the topics and 2D coordinates of representatives back out to every
+    review of their group. Duplicates get a small seeded jitter around their
+    representative so they stay visible as separate points on the map.
+    """
+    representatives, inverse = duplicate_groups
+    spread = coords.std(axis=0)
+    jitter = np.random.RandomState(42).normal(
+        scale=DEDUP_JITTER * spread, size=(len(inverse), 2)
+    )
+    duplicate = representatives[inverse] != np.arange(len(inverse))
+    return (
+        np.asarray(topics)[inverse].tolist(),
+        coords[inverse] + jitter * duplicate[:, None],
+    )
+
+
+def _cluster_category_job(job) -> dict:
+    """Runs in a pool process; returns the job's own timings under `metrics`."""
+    category, texts, embeddings, save_dir, weights = job
+    print("processing category:", category)
+    metrics.reset()
+    result = cluster_category(texts, embeddings, save_dir=save_dir, weights=weights)
+    result["metrics"] = metrics.summary()
+    return result
+
+
+def job_rows(job) -> int:
+    """Reviews covered by a clustering job, counting collapsed duplicates."""
+    weights = job[4]
+    return len(job[1]) if weights is None else int(weights.sum())
+
+
+def cluster_categories(
+    category_jobs,
+    embedding_model,
+    save_root: Optional[str] = None,
+    progress: Optional[ProgressReporter] = None,
+) -> Iterator[dict]:
+    """
+    Runs `cluster_category` for every (category, subset, embeddings) job and
+    yields each result as soon as it is ready. A `weight` column in the
+    subset is passed on as the topic weights.
+    Categories are independent, so with CATEGORY_WORKERS > 1 they are fanned
+    out over a process pool; results always come back in job order. The
+    pool spawns fresh interpreters, since forking after torch and numba have
+    started their thread pools is not safe, and the timings recorded in the
+    pool processes are merged into `metrics`.
+    """
+    total_cats = len(category_jobs)
+    jobs = [
+        (
+            category,
+            subset["text"].tolist(),
+            embeddings,
+            os.path.join(save_root, f"category-{i}") if save_root else None,
+            subset["weight"].to_numpy() if "weight" in subset.columns else None,
+        )
+        for i, (category, subset, embeddings) in enumerate(category_jobs)
+    ]
+
+    pool, results = None, None
+    if CATEGORY_WORKERS > 1 and total_cats > 1:
+        try:
+            pool = ProcessPoolExecutor(
+                max_workers=min(CATEGORY_WORKERS, total_cats),
+                mp_context=multiprocessing.get_context("spawn"),
             )
+            # Workers start on submit, so only this part can hit the daemon limit;
+            # errors from the jobs themselves surface while iterating below
+            results = pool.map(_cluster_category_job, jobs)
+        except AssertionError as e:
+            # Daemonic pool workers (e.g. Celery prefork) cannot have children
+            print(f"Process pool unavailable, clustering sequentially: {e}")
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+            pool = None
+
+    if pool is not None:
+        with pool:
+            rows_done = 0
+            for idx, result in enumerate(results):
+                metrics.merge(result.pop("metrics"))
+                rows_done += job_rows(jobs[idx])
+                if progress is not None:
+                    progress.stage("topic-fit", idx + 1, rows_done)
+                yield result
+        return
+
+    rows_done = 0
+    for idx, (category, texts, embeddings, save_dir, weights) in enumerate(jobs):
+        print("processing category:", category)
+        on_stage = None
+        if progress is not None:
+            progress.stage("topic-fit", idx, rows_done)
+            on_stage = functools.partial(
+                progress.stage, category_index=idx, rows_done=rows_done
+            )
+        yield cluster_category(
+            texts, embeddings, embedding_model, save_dir, on_stage, weights
+        )
+        rows_done += job_rows(jobs[idx])
+
+
+def finish_categories(
+    result_frames: List[pd.DataFrame],
+    cluster_summaries: List[dict],
+    summary_jobs: list,
+    on_stage: Optional[Callable[[str], None]] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Summarizes the given clusters in place and classifies the sentiment of
+    the clustered reviews. Returns the reviews with cluster titles, sentiment
+    and confidence, or None when there are none. `on_stage` is called with
+    "summarize" and "sentiment" as each starts.
+    """
+    if on_stage is not None:
+        on_stage("summarize")
+    for summary, info in zip(cluster_summaries, generate_summaries(summary_jobs)):
+        print(f"Cluster {summary['global_id']} info: {info}")
+        summary["title"] = info.get("title", "No Title")
+        summary["description"] = info.get("description", "No Description")
+
+    if not result_frames:
+        return None
+    final_df = pd.concat(result_frames)
+    cluster_titles = {s["global_id"]: s["title"] for s in cluster_summaries}
+    final_df["cluster_title"] = final_df["cluster_id"].map(cluster_titles).fillna("Шум")
+
+    print("Estimating sentiment...")
+    if on_stage is not None:
+        on_stage("sentiment")
+
+    # Each distinct `sentiment_text` (a review or its near-duplicate
+    # representative) is classified once
+    codes, sentiment_texts = pd.factorize(final_df["sentiment_text"])
+    labels, confidences = predict_sentiment(sentiment_texts.tolist())
+
+    final_df["sentiment"] = SENTIMENT_LABELS[np.asarray(labels, dtype=np.int64)[codes]]
+    final_df["confidence"] = np.asarray(confidences)[codes]
+    return final_df
+
 
-    for summary in cluster_summaries:
-        clusters.append(
-            {
-                "id": int(summary["global_id"]),
-                "title": summary["title"],
-                "summary": summary["description"],
+def cluster_records(cluster_summaries: List[dict]) -> List[dict]:
+    return [
+        {
+            "id": int(summary["global_id"]),
+            "title": summary["title"],
+            "summary": summary["description"],
+        }
+        for summary in cluster_summaries
+    ]
+
+
+class ResultStream:
+    """
+    Publishes partial results of an analysis to the Redis stream
+    `analysis-stream:<task_arg_id>`: a "start" entry, one "category" entry
+    per finished category and a final "done" entry. Every entry has an
+    `event` field and a JSON `data` field. Does nothing unless RESULT_STREAM
+    is set and the result backend is Redis.
+    """
+
+    def __init__(self, task_arg_id: str) -> None:
+        self.key = f"analysis-stream:{task_arg_id}"
+        self.client = getattr(app.backend, "client", None) if RESULT_STREAM else None
+        if self.client is not None:
+            # A retried task starts the stream over
+            self._call(self.client.delete, self.key)
+
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+
+    def publish(self, event: str, data: Optional[dict] = None) -> None:
+        if self.client is None:
+            return
+        fields = {"event": event, "data": json.dumps(data or {}, ensure_ascii=False)}
+        self._call(self.client.xadd, self.key, fields)
+        self._call(self.client.expire, self.key, RESULT_STREAM_TTL_S)
+
+    @staticmethod
+    def _call(method, *args) -> None:
+        # Streaming is best effort: the full result still goes through the task result
+        try:
+            method(*args)
+        except Exception as e:
+            print(f"Result stream error: {e}")
+
+
+def analysis_state_dir(task_arg_id: str) -> str:
+    return os.path.join(ANALYSIS_STORE_DIR, re.sub(r"[^\w.-]+", "_", task_arg_id))
+
+
+def source_rows(reviews: pd.DataFrame) -> pd.DataFrame:
+    """The uploaded columns of parsed reviews, in file order."""
+    return reviews.sort_values("row")[[c for c in CSV_COLUMNS if c in reviews.columns]]
+
+
+def save_analysis_state(
+    save_root: str, category_jobs, category_remaps, clusters, reviews: pd.DataFrame
+) -> None:
+    """
+    Writes the manifest tying persisted category models to global cluster
+    ids, and the analysed reviews so a later append can trigger a refit.
+    """
+    os.makedirs(save_root, exist_ok=True)
+    source_rows(reviews).to_csv(
+        os.path.join(save_root, "reviews.csv.gz"), index=False, compression="gzip"
+    )
+    state = {
+        "categories": {
+            category: {
+                "dir": f"category-{i}",
+                "remap": {str(local_id): global_id for local_id, global_id in remap.items()},
             }
+            for i, ((category, _, _), remap) in enumerate(zip(category_jobs, category_remaps))
+        },
+        "clusters": clusters,
+    }
+    with open(os.path.join(save_root, "state.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+
+
+def load_analysis_state(task_arg_id: str) -> Optional[dict]:
+    path = os.path.join(analysis_state_dir(task_arg_id), "state.json")
+    if not ANALYSIS_STORE_DIR or not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_appended_state(
+    base_task_arg_id: str, task_arg_id: str, state: dict, groups: Dict[str, pd.DataFrame]
+) -> None:
+    """
+    Persists an append as an analysis of its own: its manifest points at the
+    category models of the base, and its reviews are the base reviews
+    followed by the appended batch.
+    """
+    base_dir = analysis_state_dir(base_task_arg_id)
+    save_root = analysis_state_dir(task_arg_id)
+    os.makedirs(save_root, exist_ok=True)
+
+    base_reviews = os.path.join(base_dir, "reviews.csv.gz")
+    if os.path.exists(base_reviews):
+        parts = [pd.read_csv(base_reviews, dtype=CSV_COLUMNS)]
+        if groups:
+            parts.append(source_rows(pd.concat(groups.values())))
+        combined = pd.concat(parts, ignore_index=True)
+        combined.to_csv(
+            os.path.join(save_root, "reviews.csv.gz"), index=False, compression="gzip"
         )
+    else:
+        print(f"No persisted reviews for {base_task_arg_id}, {task_arg_id} cannot be refit")
+
+    categories = {
+        category: {
+            # Chains of appends all point straight at the directory of the fit
+            "dir": os.path.relpath(
+                os.path.normpath(os.path.join(base_dir, category_state["dir"])), save_root
+            ),
+            "remap": category_state["remap"],
+        }
+        for category, category_state in state["categories"].items()
+    }
+    with open(os.path.join(save_root, "state.json"), "w", encoding="utf-8") as f:
+        json.dump({"categories": categories, "clusters": state["clusters"]}, f, ensure_ascii=False)
 
+
+def build_review_columns(final_df: pd.DataFrame) -> Dict[str, list]:
+    """Converts the per-review results into plain Python lists, one per output field."""
+    source_ids = final_df["ID"] if "ID" in final_df.columns else final_df["src"]
+    return {
+        "source_id": source_ids.map(str).tolist(),
+        "text": final_df["text"].tolist(),
+        "sentiment": final_df["sentiment"].tolist(),
+        "confidence": final_df["confidence"].astype(float).tolist(),
+        "cluster_id": final_df["cluster_id"].astype(int).tolist(),
+        "x": final_df["x"].astype(float).tolist(),
+        "y": final_df["y"].astype(float).tolist(),
+        "row": final_df["row"].astype(int).tolist(),
+    }
+
+
+def columns_to_records(columns: Dict[str, list]) -> List[dict]:
+    return [
+        {
+            "source_id": source_id,
+            "text": text,
+            "sentiment": sentiment,
+            "confidence": confidence,
+            "cluster_id": cluster_id,
+            "coords": {"x": x, "y": y},
+        }
+        for source_id, text, sentiment, confidence, cluster_id, x, y in zip(
+            *(columns[column] for column in REVIEW_COLUMNS)
+        )
+    ]
+
+
+def write_result_artifact(
+    task_arg_id: str, review_columns: Dict[str, list], keep_text: bool = False
+) -> str:
+    """
+    Writes the review columns as gzip-compressed JSON to RESULT_STORE_DIR and
+    returns the file name. Unless `keep_text` is set, review text is left out:
+    the backend joins it back from its copy of the upload through the `row`
+    column.
+    """
+    os.makedirs(RESULT_STORE_DIR, exist_ok=True)
+    name = re.sub(r"[^\w.-]+", "_", task_arg_id) + ".json.gz"
+    path = os.path.join(RESULT_STORE_DIR, name)
+
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        json.dump(
+            {k: v for k, v in review_columns.items() if keep_text or k != "text"},
+            f,
+            ensure_ascii=False,
+        )
+    os.replace(tmp_path, path)
+    return name
+
+
+def format_result(
+    review_columns: Dict[str, list],
+    clusters: List[dict],
+    task_arg_id: str,
+    result_format: str,
+    result_store: str,
+    keep_text: bool = False,
+) -> dict:
+    """
+    Packs a task result in the requested format and storage mode. Artifacts
+    keep the review text only with `keep_text`, for payloads the backend
+    holds no upload for.
+    """
+    if result_store == "artifact":
+        return {
+            "status": "success",
+            "format": "artifact",
+            "artifact": {
+                "path": write_result_artifact(task_arg_id, review_columns, keep_text),
+                "encoding": "json+gzip",
+            },
+            "counts": {
+                "reviews": len(review_columns["row"]),
+                "clusters": len(clusters),
+            },
+            "clusters": clusters,
+        }
+    if result_format == "columnar":
+        return {
+            "status": "success",
+            "format": "columnar",
+            "review_columns": review_columns,
+            "clusters": clusters,
+        }
     return {
         "status": "success",
-        "reviews": reviews,
+        "reviews": columns_to_records(review_columns),
         "clusters": clusters,
     }
+
+
+@app.task(bind=True, name="worker.process_file")
+def run_clustering_task(
+    self,
+    csv_data: str,
+    task_arg_id: str,
+    result_format: str = "records",
+    result_store: str = "inline",
+):
+    """
+    Clusters, summarizes and classifies the reviews of one uploaded CSV.
+    `result_format` is "records" (a list of review objects) or "columnar"
+    (one array per review field under `review_columns`).
+    With `result_store="artifact"` the reviews are written to a compressed
+    file in RESULT_STORE_DIR and only a small manifest is returned.
+    Progress is published as PROGRESS state meta while the task runs; with
+    RESULT_STREAM=1 every finished category is also published right away
+    through `ResultStream`.
+    """
+    return analyze_csv(self, csv_data, task_arg_id, result_format, result_store)
+
+
+@app.task(bind=True, name="worker.refit_analysis")
+def refit_analysis_task(
+    self,
+    source_task_arg_id: str,
+    task_arg_id: str,
+    result_format: str = "records",
+    result_store: str = "inline",
+):
+    """
+    Runs the full worker.process_file pipeline over the persisted reviews of
+    `source_task_arg_id`, typically an append whose reviews no longer fit
+    the clusters of its base. Those reviews include every earlier append in
+    its chain.
+    """
+    path = os.path.join(analysis_state_dir(source_task_arg_id), "reviews.csv.gz")
+    if not ANALYSIS_STORE_DIR or not os.path.exists(path):
+        return {"status": "error", "message": "Нет сохранённых отзывов для пересчёта"}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        csv_data = f.read()
+    return analyze_csv(self, csv_data, task_arg_id, result_format, result_store)
+
+
+def analyze_csv(
+    task, csv_data: str, task_arg_id: str, result_format: str, result_store: str
+) -> dict:
+    """Body of worker.process_file, shared with worker.refit_analysis."""
+    metrics.reset()
+    reset_peak_rss()
+    stream = ResultStream(task_arg_id)
+    progress = ProgressReporter(task, streaming=stream.enabled)
+    stream.publish("start")
+    # Clients of the stream wait for "done", so it is published however the task ends
+    done = {"status": "error", "message": "Ошибка обработки"}
+    try:
+        progress.stage("parse")
+        try:
+            with metrics.timer("parse"):
+                groups = read_reviews_by_source(open_csv_source(csv_data))
+        except KeyError:
+            done = {"status": "error", "message": "В CSV нет колонок text или src"}
+            return done
+        except (OSError, ValueError):
+            done = {"status": "error", "message": "Не удалось прочитать файл"}
+            return done
+        metrics.inc("rows", sum(len(subset) for subset in groups.values()))
+
+        # Categories with fewer than 5 reviews are not clustered
+        eligible = {category: subset for category, subset in groups.items() if len(subset) >= 5}
+        progress.total_categories = len(eligible)
+        progress.rows_total = sum(len(subset) for subset in eligible.values())
+        # Only one review per group of near-duplicates is embedded and clustered
+        with metrics.timer("dedup"):
+            collapsed = [collapse_duplicates(subset) for subset in eligible.values()]
+        # Embed every category that will be clustered in one pass so cache misses
+        # from all sources are encoded together
+        progress.stage("embed")
+        all_embeddings = (
+            embed_texts(
+                batch_clean_text(pd.concat([reps for reps, _ in collapsed])["text"].tolist())
+            )
+            if eligible
+            else None
+        )
+        embedding_offset = 0
+
+        category_jobs = []
+        category_duplicates = []
+        for category, (reps, duplicate_groups) in zip(eligible, collapsed):
+            embeddings = all_embeddings[embedding_offset : embedding_offset + len(reps)]
+            embedding_offset += len(reps)
+            category_jobs.append((category, reps, embeddings))
+            category_duplicates.append(duplicate_groups)
+
+        result_frames = []
+        cluster_summaries = []
+        summary_jobs = []
+        category_remaps = []
+        finished_frames = []
+        rows_finished = 0
+        topic_offset = 0
+        save_root = analysis_state_dir(task_arg_id) if ANALYSIS_STORE_DIR else None
+
+        # Global cluster ids are assigned in category order, whatever order the
+        # categories finish in. The embedding model stays resident while BERTopic
+        # holds it, even if loading the summarizer goes over the RAM budget
+        with models.using("embedding") as embedding_model, metrics.timer("cluster"):
+            for idx, ((category, _, _), result) in enumerate(
+                zip(
+                    category_jobs,
+                    cluster_categories(category_jobs, embedding_model, save_root, progress),
+                )
+            ):
+                top_ids = result["top_ids"]
+                remap_dict = {old_id: i for i, old_id in enumerate(top_ids)}
+                category_remaps.append(
+                    {old_id: i + topic_offset for old_id, i in remap_dict.items()}
+                )
+
+                category_summaries, category_summary_jobs = [], []
+                for local_id, keywords, sample_texts, count in zip(
+                    top_ids, result["keywords"], result["samples"], result["counts"]
+                ):
+                    category_summary_jobs.append((keywords, sample_texts))
+                    category_summaries.append(
+                        {
+                            "global_id": remap_dict[local_id] + topic_offset,
+                            "category": category,
+                            "review_count": count,
+                            "keywords": ", ".join(keywords),
+                        }
+                    )
+                summary_jobs.extend(category_summary_jobs)
+                cluster_summaries.extend(category_summaries)
+
+                subset = eligible[category]
+                topics, coords = result["topics"], result["coords"]
+                # Near-duplicates share their representative's sentiment as well
+                subset["sentiment_text"] = subset["text"]
+                duplicate_groups = category_duplicates[idx]
+                if duplicate_groups is not None:
+                    topics, coords = expand_duplicates(topics, coords, duplicate_groups)
+                    representatives, inverse = duplicate_groups
+                    subset["sentiment_text"] = subset["text"].to_numpy()[representatives[inverse]]
+
+                subset["cluster_id"] = [
+                    remap_dict[t] + topic_offset if t in remap_dict else -1
+                    for t in topics
+                ]
+                subset["x"] = coords[:, 0]
+                subset["y"] = coords[:, 1]
+
+                result_frames.append(subset)
+
+                if len(top_ids) > 0:
+                    topic_offset += len(top_ids)
+
+                if stream.enabled:
+                    rows_finished += len(subset)
+                    # Finish this category on its own instead of batching it with the
+                    # rest: its titles arrive early, at the cost of smaller generate()
+                    # batches
+                    category_df = finish_categories(
+                        [subset],
+                        category_summaries,
+                        category_summary_jobs,
+                        functools.partial(
+                            progress.stage,
+                            category_index=idx + 1,
+                            rows_done=rows_finished,
+                        ),
+                    )
+                    finished_frames.append(category_df)
+                    stream.publish(
+                        "category",
+                        {
+                            "category": category,
+                            "category_index": idx,
+                            "total_categories": len(category_jobs),
+                            "clusters": cluster_records(category_summaries),
+                            "review_columns": build_review_columns(category_df),
+                        },
+                    )
+
+        # Drop the reference so evicting the embedding model actually frees it
+        del embedding_model
+
+        # Without streaming all clusters of the analysis are summarized together
+        # in batched generate() calls
+        if stream.enabled:
+            final_df = pd.concat(finished_frames) if finished_frames else None
+        else:
+            final_df = finish_categories(
+                result_frames,
+                cluster_summaries,
+                summary_jobs,
+                functools.partial(
+                    progress.stage,
+                    category_index=progress.total_categories,
+                    rows_done=progress.rows_total,
+                ),
+            )
+
+        review_columns = {column: [] for column in REVIEW_COLUMNS + ["row"]}
+        if final_df is not None:
+            review_columns = build_review_columns(final_df)
+        clusters = cluster_records(cluster_summaries)
+
+        if save_root and groups:
+            save_analysis_state(
+                save_root, category_jobs, category_remaps, clusters, pd.concat(groups.values())
+            )
+
+        result = format_result(
+            review_columns,
+            clusters,
+            task_arg_id,
+            result_format,
+            result_store,
+            keep_text=not csv_data.startswith("file://"),
+        )
+        result["metrics"] = metrics.summary()
+        if prediction_cache is not None:
+            result["metrics"]["prediction_cache"] = prediction_cache.stats()
+        done = {"status": "success", "categories": len(category_jobs), "clusters": len(clusters)}
+        return result
+    finally:
+        stream.publish("done", done)
+
+
+@app.task(bind=True, name="worker.append_reviews")
+def append_reviews_task(
+    self,
+    csv_data: str,
+    task_arg_id: str,
+    base_task_arg_id: str,
+    result_format: str = "records",
+    result_store: str = "inline",
+):
+    """
+    Assigns a new batch of reviews to the clusters of the finished analysis
+    `base_task_arg_id` using its persisted topic models and 2D projectors,
+    without refitting or summarizing. Categories whose outlier share exceeds
+    REFIT_OUTLIER_RATE, or that the base analysis never saw, are listed in
+    `refit_required`; worker.refit_analysis can then re-analyse this append.
+    The append is persisted as an analysis of its own, sharing the base
+    models and holding the base reviews plus the batch, so it can be the
+    base of further appends and refits.
+    """
+    metrics.reset()
+    reset_peak_rss()
+    state = load_analysis_state(base_task_arg_id)
+    if state is None:
+        return {"status": "error", "message": "Нет сохранённой модели для анализа"}
+
+    try:
+        with metrics.timer("parse"):
+            groups = read_reviews_by_source(open_csv_source(csv_data))
+    except KeyError:
+        return {"status": "error", "message": "В CSV нет колонок text или src"}
+    except (OSError, ValueError):
+        return {"status": "error", "message": "Не удалось прочитать файл"}
+    metrics.inc("rows", sum(len(subset) for subset in groups.values()))
+
+    review_columns = {column: [] for column in REVIEW_COLUMNS + ["row"]}
+    outlier_rates = {}
+    refit_required = []
+
+    if groups:
+        final_df = pd.concat(groups.values())
+        embeddings = embed_texts(batch_clean_text(final_df["text"].tolist()))
+        state_dir = analysis_state_dir(base_task_arg_id)
+
+        cluster_ids, coords = [], []
+        offset = 0
+        for category, subset in groups.items():
+            category_embeddings = embeddings[offset : offset + len(subset)]
+            offset += len(subset)
+
+            category_state = state["categories"].get(category)
+            if category_state is None:
+                cluster_ids.extend([-1] * len(subset))
+                coords.append(np.zeros((len(subset), 2)))
+                outlier_rates[category] = 1.0
+                refit_required.append(category)
+                continue
+
+            topics, category_coords = assign_category(
+                os.path.join(state_dir, category_state["dir"]),
+                subset["text"].tolist(),
+                category_embeddings,
+            )
+            remap = category_state["remap"]
+            cluster_ids.extend(remap.get(str(t), -1) for t in topics)
+            coords.append(category_coords)
+
+            outlier_rates[category] = sum(1 for t in topics if t == -1) / len(topics)
+            if outlier_rates[category] > REFIT_OUTLIER_RATE:
+                refit_required.append(category)
+
+        coords = np.concatenate(coords)
+        final_df["cluster_id"] = cluster_ids
+        final_df["x"] = coords[:, 0]
+        final_df["y"] = coords[:, 1]
+
+        labels, confidences = predict_sentiment(final_df["text"].tolist())
+        final_df["sentiment"] = SENTIMENT_LABELS[np.asarray(labels, dtype=np.int64)]
+        final_df["confidence"] = confidences
+
+        review_columns = build_review_columns(final_df)
+
+    save_appended_state(base_task_arg_id, task_arg_id, state, groups)
+
+    result = format_result(
+        review_columns,
+        state["clusters"],
+        task_arg_id,
+        result_format,
+        result_store,
+        keep_text=not csv_data.startswith("file://"),
+    )
+    result["outlier_rates"] = outlier_rates
+    result["refit_required"] = refit_required
+    result["metrics"] = metrics.summary()
+    if prediction_cache is not None:
+        result["metrics"]["prediction_cache"] = prediction_cache.stats()
+    return result
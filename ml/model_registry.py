@@ -0,0 +1,177 @@
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+
+def resident_bytes(obj: Any) -> int:
+    """
+    Approximate memory held by a model: parameters and buffers of torch
+    modules, or the graph file size of an onnxruntime session.
+    """
+    if isinstance(obj, (tuple, list)):
+        return sum(resident_bytes(item) for item in obj)
+    if hasattr(obj, "parameters") and hasattr(obj, "buffers"):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    if getattr(obj, "session", None) is not None and getattr(obj, "onnx_path", None):
+        # onnxruntime holds its weights outside Python; the initializers in the
+        # graph file (and its external data, if any) are a close estimate
+        paths = [obj.onnx_path, obj.onnx_path + ".data"]
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    if hasattr(obj, "model"):
+        # Inference wrappers such as SentimentEngine
+        return resident_bytes(obj.model)
+    return 0
+
+
+class _Entry:
+    def __init__(self, loader: Callable[[], Any], hot: bool, on_evict: Optional[Callable[[], None]]):
+        self.loader = loader
+        self.hot = hot
+        self.on_evict = on_evict
+        self.value: Any = None
+        self.size = 0
+        self.load_seconds = 0.0
+        self.last_used = 0.0
+        self.loads = 0
+        self.pinned = False
+        self.users = 0
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models resident within a RAM budget.
+
+    Models are registered with a loader and loaded on first `get`. When the
+    resident total exceeds `budget_bytes` the least recently used models are
+    evicted; models idle for longer than `idle_timeout` seconds are evicted by
+    `evict_idle`, except the ones marked hot. Pinned models and models held
+    through `using` are never evicted. A budget or timeout of 0 disables the
+    respective policy.
+    """
+
+    def __init__(self, budget_bytes: int = 0, idle_timeout: float = 0) -> None:
+        self.budget_bytes = budget_bytes
+        self.idle_timeout = idle_timeout
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.RLock()
+
+    def register(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        hot: bool = False,
+        on_evict: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self._entries[name] = _Entry(loader, hot, on_evict)
+
+    def hot_models(self) -> list:
+        return [name for name, entry in self._entries.items() if entry.hot]
+
+    def get(self, name: str) -> Any:
+        with self._lock:
+            entry = self._entries[name]
+            entry.last_used = time.monotonic()
+            if entry.value is None:
+                start = time.perf_counter()
+                entry.value = entry.loader()
+                entry.load_seconds = time.perf_counter() - start
+                entry.size = resident_bytes(entry.value)
+                entry.loads += 1
+                print(
+                    f"Loaded model {name}: {entry.load_seconds:.1f}s, "
+                    f"{entry.size / 2**20:.0f} MB resident"
+                )
+                self._enforce_budget(keep=name)
+            return entry.value
+
+    @contextmanager
+    def using(self, name: str) -> Iterator[Any]:
+        """
+        Like `get`, for callers that keep the model across other loads:
+        evicting it meanwhile would free nothing while they hold a reference.
+        """
+        with self._lock:
+            value = self.get(name)
+            entry = self._entries[name]
+            entry.users += 1
+        try:
+            yield value
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+
+    def preload(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.get(name)
+
+    def pin(self, names: Iterable[str]) -> None:
+        for name in names:
+            self._entries[name].pinned = True
+
+    def evict(self, name: str) -> None:
+        with self._lock:
+            entry = self._entries[name]
+            if entry.value is None:
+                return
+            entry.value = None
+            entry.size = 0
+            if entry.on_evict is not None:
+                entry.on_evict()
+            gc.collect()
+            print(f"Evicted model {name}")
+
+    def evict_idle(self) -> None:
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for name, entry in self._entries.items():
+                if (
+                    entry.value is not None
+                    and not entry.hot
+                    and not entry.pinned
+                    and not entry.users
+                    and now - entry.last_used > self.idle_timeout
+                ):
+                    self.evict(name)
+
+    def _enforce_budget(self, keep: str) -> None:
+        if not self.budget_bytes:
+            return
+        loaded = sorted(
+            (entry.last_used, name)
+            for name, entry in self._entries.items()
+            if entry.value is not None and not entry.pinned and not entry.users and name != keep
+        )
+        for _, name in loaded:
+            if self.resident_total() <= self.budget_bytes:
+                break
+            self.evict(name)
+        if self.resident_total() > self.budget_bytes:
+            print(
+                f"Models in use hold {self.resident_total() / 2**20:.0f} MB, "
+                f"over the {self.budget_bytes / 2**20:.0f} MB budget"
+            )
+
+    def resident_total(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "loaded": entry.value is not None,
+                    "hot": entry.hot,
+                    "pinned": entry.pinned,
+                    "users": entry.users,
+                    "resident_bytes": entry.size,
+                    "load_seconds": entry.load_seconds,
+                    "loads": entry.loads,
+                }
+                for name, entry in self._entries.items()
+            }
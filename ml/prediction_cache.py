@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class PredictionCache:
+    """
+    Memo of classifier outputs keyed by a hash of the cleaned text and the
+    model fingerprint.
+
+    The first tier is an in-process LRU bounded to `max_entries`; with
+    `redis_url` a shared Redis tier is consulted on local misses and filled
+    on every put, with entries expiring after `ttl_seconds`. Values are
+    float32 logits rows.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        redis_url: Optional[str] = None,
+        ttl_seconds: int = 7 * 24 * 3600,
+        namespace: str = "sentiment-cache",
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.redis = None
+        if redis_url:
+            import redis
+
+            self.redis = redis.Redis.from_url(redis_url)
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.redis_errors = 0
+
+    @staticmethod
+    def key(fingerprint: str, cleaned_text: str) -> str:
+        payload = f"{fingerprint}\0{cleaned_text}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[int, np.ndarray]:
+        """Returns the cached logits by position in `keys`."""
+        found: Dict[int, np.ndarray] = {}
+        with self._lock:
+            for i, k in enumerate(keys):
+                value = self._entries.get(k)
+                if value is not None:
+                    self._entries.move_to_end(k)
+                    found[i] = value
+        local_hits = len(found)
+
+        missing = [i for i in range(len(keys)) if i not in found]
+        if self.redis is not None and missing:
+            try:
+                values = self.redis.mget([f"{self.namespace}:{keys[i]}" for i in missing])
+            except Exception as e:
+                self.redis_errors += 1
+                print(f"Prediction cache Redis error: {e}")
+                values = [None] * len(missing)
+            promoted = {}
+            for i, raw in zip(missing, values):
+                if raw is None:
+                    continue
+                value = np.frombuffer(raw, dtype=np.float32).copy()
+                found[i] = value
+                promoted[keys[i]] = value
+            self._put_local(promoted)
+            self.redis_hits += len(promoted)
+
+        self.hits += local_hits
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        if not items:
+            return
+        self._put_local(items)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for k, logits in items.items():
+                raw = np.asarray(logits, dtype=np.float32).tobytes()
+                pipe.set(f"{self.namespace}:{k}", raw, ex=self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            self.redis_errors += 1
+            print(f"Prediction cache Redis error: {e}")
+
+    def _put_local(self, items: Dict[str, np.ndarray]) -> None:
+        with self._lock:
+            for k, value in items.items():
+                self._entries[k] = value
+                self._entries.move_to_end(k)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.redis_hits + self.misses
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.redis_hits) / total if total else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "redis_errors": self.redis_errors,
+        }
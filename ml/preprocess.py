@@ -1,9 +1,12 @@
+import hashlib
 import html
+import os
 import re
-from typing import Dict, List, Optional
+import shutil
+from typing import Dict, List, Optional, Union
 
 import pandas as pd
-from datasets import Dataset
+from datasets import Dataset, load_from_disk
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 
@@ -47,15 +50,57 @@ def tokenize_batch(
     examples: Dict[str, List[str]],
     tokenizer: PreTrainedTokenizerBase,
     max_length: int = 256,
+    padding: Union[bool, str] = "max_length",
 ) -> Dict[str, List[List[int]]]:
     return tokenizer(
         examples["text"],
-        padding="max_length",
+        padding=padding,
         truncation=True,
         max_length=max_length,
     )
 
 
+# Bump when the cleaning or tokenization steps change to invalidate old caches
+DATASET_CACHE_VERSION = 1
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """Content hash of the tokenizer: vocabulary, normalization and special tokens."""
+    if tokenizer.is_fast:
+        payload = tokenizer.backend_tokenizer.to_str()
+    else:
+        payload = f"{type(tokenizer).__name__}\0{tokenizer.name_or_path}\0{len(tokenizer)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def dataset_cache_key(
+    csv_path: str,
+    tokenizer: PreTrainedTokenizerBase,
+    max_length: int,
+    text_column: str = "text",
+    label_column: Optional[str] = "label",
+) -> str:
+    payload = "\0".join(
+        [
+            str(DATASET_CACHE_VERSION),
+            file_sha256(csv_path),
+            tokenizer_fingerprint(tokenizer),
+            str(max_length),
+            text_column,
+            str(label_column),
+        ]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
 def prepare_dataset(
     csv_path: str,
     tokenizer: Optional[PreTrainedTokenizerBase] = None,
@@ -63,30 +108,60 @@ def prepare_dataset(
     max_length: int = 256,
     text_column: str = "text",
     label_column: Optional[str] = "label",
+    cache_dir: Optional[str] = None,
 ) -> Dataset:
     """
-    Load CSV, clean text, and convert to HuggingFace Dataset.
-    If tokenizer is provided, tokenization is applied immediately.
+    Load CSV, clean text, and convert to a tokenized HuggingFace Dataset.
+    Rows are not padded (pad per batch with DataCollatorWithPadding) and carry
+    a `length` column for length-grouped sampling.
+    With `cache_dir` the result is saved there as an Arrow dataset keyed by
+    the CSV contents, the tokenizer and `max_length`, and later calls with
+    the same inputs load it instead of re-tokenizing.
     """
     if tokenizer is None:
         if model_name is None:
             raise ValueError("Either tokenizer or model_name must be provided.")
         tokenizer = get_tokenizer(model_name, max_length=max_length)
 
+    cache_path = None
+    if cache_dir:
+        key = dataset_cache_key(csv_path, tokenizer, max_length, text_column, label_column)
+        cache_path = os.path.join(cache_dir, key)
+        if os.path.isdir(cache_path):
+            print("Loading tokenized dataset from", cache_path)
+            return load_from_disk(cache_path)
+
     df = load_csv(csv_path, text_column=text_column)
     df[text_column] = batch_clean_text(df[text_column].tolist())
     if label_column and label_column in df.columns:
         df[label_column] = df[label_column].astype(int)
 
     dataset = Dataset.from_pandas(df)
-    dataset = dataset.rename_column(text_column, "text")
+    if text_column != "text":
+        dataset = dataset.rename_column(text_column, "text")
     if label_column and label_column in dataset.column_names:
         dataset = dataset.rename_column(label_column, "labels")
 
     keep_labels = {"labels"}
     dataset = dataset.map(
-        lambda x: tokenize_batch(x, tokenizer=tokenizer, max_length=max_length),
+        lambda x: tokenize_batch(x, tokenizer=tokenizer, max_length=max_length, padding=False),
         batched=True,
         remove_columns=[col for col in dataset.column_names if col not in keep_labels],
     )
+    dataset = dataset.map(
+        lambda x: {"length": [len(ids) for ids in x["input_ids"]]},
+        batched=True,
+    )
+
+    if cache_path is not None:
+        # Save under a temporary name first so an interrupted run leaves no partial cache
+        tmp_path = cache_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        dataset.save_to_disk(tmp_path)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Another run cached the same dataset in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print("Tokenized dataset cached to", cache_path)
     return dataset
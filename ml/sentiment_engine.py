@@ -0,0 +1,346 @@
+import contextlib
+import hashlib
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+from fast_classifier import FastClassifier
+from prediction_cache import PredictionCache
+from preprocess import batch_clean_text
+from utils.instrumentation import Metrics
+
+# torch: eager fp32; torch-int8: dynamically quantized nn.Linear layers (CPU);
+# onnxruntime: a graph written by export_onnx.py, fp32 or int8
+BACKENDS = ("torch", "torch-int8", "onnxruntime")
+
+# Which part of the engine answered a text
+TIER_FAST = 0
+TIER_TRANSFORMER = 1
+TIER_CACHE = 2
+TIER_NAMES = {TIER_FAST: "fast", TIER_TRANSFORMER: "transformer", TIER_CACHE: "cache"}
+
+
+def length_buckets(lengths: List[int], token_budget: int) -> List[List[int]]:
+    """
+    Groups row indices by token length so that every bucket, once padded to
+    its longest row, stays within `token_budget` tokens.
+    Longest rows come first so an oversized bucket fails early.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    buckets: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        if current and (len(current) + 1) * lengths[current[0]] > token_budget:
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def model_fingerprint(*paths: Optional[str], settings: str = "") -> str:
+    """
+    Identifies the models behind cached predictions by the names, sizes and
+    mtimes of their files, plus any settings that change the outputs.
+    """
+    parts = [settings]
+    for path in paths:
+        if not path:
+            continue
+        files = (
+            [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            if os.path.isdir(path)
+            else [path]
+        )
+        for file_path in files:
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                parts.append(f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}")
+            else:
+                parts.append(file_path)
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return shifted / shifted.sum(axis=-1, keepdims=True)
+
+
+class SentimentEngine:
+    """
+    Batched inference for the sentiment classifier.
+
+    Texts are cleaned, tokenized without padding, grouped into length-sorted
+    buckets of at most `token_budget` padded tokens and padded per bucket.
+    Input is consumed `chunk_size` texts at a time, so arbitrarily long
+    iterables can be streamed through `iter_predict_proba`; the next chunk is
+    read and tokenized on a background thread while the current one runs
+    forward.
+    When `metrics` is given, tokenize/forward time and text/token/batch
+    counts are recorded under `metrics_prefix`.
+    The onnxruntime backend reads `onnx_path`, by default the fp32 graph
+    `<model_dir>/onnx/model.onnx` written by export_onnx.py.
+
+    With `fast_model_path` the engine runs as a cascade: the hashed n-gram
+    `FastClassifier` answers every text whose calibrated confidence reaches
+    `cascade_threshold`, and only the rest are tokenized and sent to the
+    transformer. Its answers are returned as log-probabilities in place of
+    logits.
+
+    With a `cache`, outputs are memoized under a hash of the cleaned text and
+    the model fingerprint: hits skip the fast tier, tokenization and forward,
+    and repeated texts within a chunk run only once.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        backend: str = "torch",
+        device: Optional[Union[str, torch.device]] = None,
+        threads: int = 0,
+        token_budget: int = 8192,
+        max_length: int = 256,
+        chunk_size: int = 4096,
+        metrics: Optional[Metrics] = None,
+        metrics_prefix: str = "",
+        onnx_path: Optional[str] = None,
+        fast_model_path: Optional[str] = None,
+        cascade_threshold: float = 0.9,
+        cache: Optional[PredictionCache] = None,
+    ) -> None:
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.backend = backend
+        self.device = torch.device(
+            device or ("cuda" if torch.cuda.is_available() else "cpu")
+        )
+        self.token_budget = token_budget
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.metrics_prefix = metrics_prefix
+        self._prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.fast_model = FastClassifier.load(fast_model_path) if fast_model_path else None
+        self.cascade_threshold = cascade_threshold
+        self.cache = cache
+        self.fingerprint = model_fingerprint(
+            model_dir,
+            onnx_path if backend == "onnxruntime" else None,
+            fast_model_path,
+            settings=f"{backend}:{max_length}:{cascade_threshold if fast_model_path else ''}",
+        )
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        self.model = None
+        self.session = None
+        self.onnx_path = None
+
+        if backend == "onnxruntime":
+            self.onnx_path = onnx_path or os.path.join(model_dir, "onnx", "model.onnx")
+            self.session = self._load_onnx_session(self.onnx_path, threads)
+            self.input_names = {i.name for i in self.session.get_inputs()}
+            self.num_labels = AutoConfig.from_pretrained(model_dir).num_labels
+            return
+
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+        self.model.eval().requires_grad_(False)
+        if backend == "torch-int8":
+            if self.device.type != "cpu":
+                raise ValueError("The torch-int8 backend only runs on CPU")
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.model.to(self.device)
+        self.num_labels = self.model.config.num_labels
+
+    def _load_onnx_session(self, path: str, threads: int):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        providers = ["CPUExecutionProvider"]
+        if self.device.type == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        return ort.InferenceSession(path, sess_options=options, providers=providers)
+
+    def iter_predict_tiers(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yields (logits, tiers) chunk by chunk, in input order. `tiers` holds
+        the TIER_* that answered each text.
+        """
+        if isinstance(texts, pd.DataFrame):
+            texts = texts[text_column]
+        iterator = iter(texts)
+
+        def read_and_tokenize():
+            chunk = list(itertools.islice(iterator, self.chunk_size))
+            return self._prepare(chunk) if chunk else None
+
+        # Reading and tokenizing the next chunk overlaps the current forward
+        pending = self._prefetcher.submit(read_and_tokenize)
+        while True:
+            prepared = pending.result()
+            if prepared is None:
+                return
+            pending = self._prefetcher.submit(read_and_tokenize)
+            yield self._infer(*prepared)
+
+    def iter_predict_logits(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> Iterator[np.ndarray]:
+        """Yields raw logits chunk by chunk, in input order."""
+        for logits, _ in self.iter_predict_tiers(texts, text_column):
+            yield logits
+
+    def iter_predict_proba(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> Iterator[np.ndarray]:
+        """Yields class probabilities chunk by chunk, in input order."""
+        for logits in self.iter_predict_logits(texts, text_column):
+            yield softmax(logits)
+
+    def predict_logits(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> np.ndarray:
+        return self._concat(self.iter_predict_logits(texts, text_column))
+
+    def predict_proba(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> np.ndarray:
+        return self._concat(self.iter_predict_proba(texts, text_column))
+
+    def predict_proba_with_tiers(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns class probabilities and the tier that answered each text."""
+        chunks = list(self.iter_predict_tiers(texts, text_column))
+        probs = self._concat(softmax(logits) for logits, _ in chunks)
+        tiers = np.concatenate([t for _, t in chunks]) if chunks else np.empty(0, np.int8)
+        return probs, tiers
+
+    def predict(
+        self, texts: Union[Iterable[str], pd.DataFrame], text_column: str = "text"
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the predicted labels and their probabilities."""
+        probs = self.predict_proba(texts, text_column)
+        return probs.argmax(axis=1), probs.max(axis=1)
+
+    def warm_up(self, texts: Sequence[str] = ("прогрев",)) -> None:
+        """
+        Runs the transformer once on `texts`, bypassing the cache, the fast
+        tier and metrics, so a fresh process has its kernels initialised.
+        """
+        encodings = self.tokenizer(
+            batch_clean_text(list(texts)), truncation=True, max_length=self.max_length
+        )
+        with torch.inference_mode():
+            self._forward(dict(encodings))
+
+    def _prepare(self, texts: List[str]):
+        """
+        Fills cache hits, runs the fast tier and tokenizes the texts left for
+        the transformer. Only the first occurrence of a repeated text is scored.
+        """
+        cleaned = batch_clean_text(texts)
+        logits = np.zeros((len(texts), self.num_labels), dtype=np.float32)
+        tiers = np.full(len(texts), TIER_TRANSFORMER, dtype=np.int8)
+        keys, duplicates = None, {}
+        todo = np.arange(len(texts))
+
+        if self.cache is not None:
+            keys = [self.cache.key(self.fingerprint, text) for text in cleaned]
+            hits = self.cache.get_many(keys)
+            for i, row in hits.items():
+                logits[i] = row
+                tiers[i] = TIER_CACHE
+            first: dict = {}
+            for i in range(len(texts)):
+                if i in hits:
+                    continue
+                if keys[i] in first:
+                    duplicates[i] = first[keys[i]]
+                else:
+                    first[keys[i]] = i
+            todo = np.fromiter(first.values(), dtype=np.int64, count=len(first))
+
+        hard = todo
+        if self.fast_model is not None and len(todo):
+            with self._timer("fast"):
+                fast_probs = self.fast_model.predict_proba([cleaned[i] for i in todo], self.num_labels)
+            confident = fast_probs.max(axis=1) >= self.cascade_threshold
+            logits[todo[confident]] = np.log(np.maximum(fast_probs[confident], 1e-12))
+            tiers[todo[confident]] = TIER_FAST
+            hard = todo[~confident]
+
+        if len(hard) == 0:
+            # Tokenizers raise on an empty batch; nothing is left for the transformer
+            return logits, tiers, hard, {"input_ids": []}, keys, todo, duplicates
+        with self._timer("tokenize"):
+            encodings = self.tokenizer(
+                [cleaned[i] for i in hard],
+                truncation=True,
+                max_length=self.max_length,
+            )
+        return logits, tiers, hard, encodings, keys, todo, duplicates
+
+    def _infer(
+        self, logits: np.ndarray, tiers: np.ndarray, hard: np.ndarray, encodings, keys, todo, duplicates
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        buckets = length_buckets(lengths, self.token_budget)
+        with self._timer("forward"), torch.inference_mode():
+            for bucket in buckets:
+                logits[hard[bucket]] = self._forward(
+                    {key: [encodings[key][i] for i in bucket] for key in encodings.keys()}
+                )
+        for i, source in duplicates.items():
+            logits[i] = logits[source]
+            tiers[i] = tiers[source]
+        if self.cache is not None:
+            self.cache.put_many({keys[i]: logits[i].copy() for i in todo})
+
+        if self.metrics is not None:
+            for tier, name in TIER_NAMES.items():
+                self.metrics.inc(f"{self.metrics_prefix}{name}_texts", int((tiers == tier).sum()))
+            self.metrics.inc(self.metrics_prefix + "texts", len(logits))
+            self.metrics.inc(self.metrics_prefix + "tokens", sum(lengths))
+            self.metrics.inc(self.metrics_prefix + "batches", len(buckets))
+        return logits, tiers
+
+    def _forward(self, encodings: dict) -> np.ndarray:
+        """Pads one bucket and returns its logits."""
+        if self.session is not None:
+            features = self.tokenizer.pad(encodings, return_tensors="np")
+            inputs = {
+                name: np.asarray(value, dtype=np.int64)
+                for name, value in features.items()
+                if name in self.input_names
+            }
+            return self.session.run(["logits"], inputs)[0]
+        features = self.tokenizer.pad(encodings, return_tensors="pt").to(self.device)
+        return self.model(**features).logits.float().cpu().numpy()
+
+    def _concat(self, chunks: Iterable[np.ndarray]) -> np.ndarray:
+        chunks = list(chunks)
+        if not chunks:
+            return np.empty((0, self.num_labels), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    def _timer(self, stage: str):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.timer(self.metrics_prefix + stage)
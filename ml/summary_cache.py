@@ -0,0 +1,85 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, List
+
+
+class SummaryCache:
+    """
+    SQLite-backed memo of generated cluster summaries.
+    Entries expire after `ttl_seconds`; beyond `max_entries` the least
+    recently read ones are dropped.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(model_name: str, template: str, keywords: List[str], documents: List[str]) -> str:
+        payload = json.dumps(
+            [model_name, template, sorted(keywords), sorted(documents)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        if not keys:
+            return {}
+        now = time.time()
+        found: Dict[str, dict] = {}
+        with self._connect() as conn:
+            unique = list(dict.fromkeys(keys))
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                chunk = unique[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, value FROM summaries WHERE created >= ? AND key IN ({placeholders})",
+                    [now - self.ttl_seconds, *chunk],
+                ).fetchall()
+                found.update((k, json.loads(v)) for k, v in rows)
+            conn.executemany(
+                "UPDATE summaries SET accessed = ? WHERE key = ?",
+                [(now, k) for k in found],
+            )
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items: Dict[str, dict]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO summaries (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False), now, now) for k, v in items.items()],
+            )
+            conn.execute("DELETE FROM summaries WHERE created < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM summaries WHERE key NOT IN "
+                "(SELECT key FROM summaries ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
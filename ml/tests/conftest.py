@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+ML_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The ml scripts import each other as top-level modules
+sys.path.insert(0, ML_DIR)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    """A randomly initialised 1-layer BERT with the project tokenizer."""
+    transformers = pytest.importorskip("transformers")
+    pytest.importorskip("torch")
+
+    path = str(tmp_path_factory.mktemp("tiny-model"))
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        os.path.join(ML_DIR, "checkpoints"), use_fast=True
+    )
+    tokenizer.save_pretrained(path)
+    config = transformers.BertConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=512,
+        num_labels=3,
+    )
+    transformers.BertForSequenceClassification(config).save_pretrained(path)
+    return path
@@ -0,0 +1,67 @@
+import numpy as np
+
+from dedup import lsh_bands, near_duplicate_groups, shingle_hashes
+
+BASE = "Курьер опоздал на два часа, заказ привезли холодным и без соуса, больше не закажу"
+
+
+def test_exact_duplicates_differing_in_case_and_spacing_are_grouped():
+    texts = [BASE, "  " + BASE.upper() + " ", "Отличный сервис, всё быстро"]
+
+    representatives, inverse = near_duplicate_groups(texts)
+
+    assert representatives.tolist() == [0, 2]
+    assert inverse.tolist() == [0, 0, 1]
+
+
+def test_near_duplicates_are_grouped_and_distinct_texts_are_not():
+    texts = [
+        BASE,
+        "Отличный сервис, всё быстро и вкусно, спасибо",
+        BASE + "!",
+        "Приложение зависает при оплате картой",
+        BASE.replace("опоздал", "опаздал"),
+    ]
+
+    representatives, inverse = near_duplicate_groups(texts, threshold=0.8)
+
+    assert representatives.tolist() == [0, 1, 3]
+    assert inverse.tolist() == [0, 1, 0, 2, 0]
+
+
+def test_threshold_controls_how_close_texts_must_be():
+    texts = [BASE, BASE.replace("холодным", "тёплым")]
+
+    assert len(near_duplicate_groups(texts, threshold=0.6)[0]) == 1
+    assert len(near_duplicate_groups(texts, threshold=0.99)[0]) == 2
+
+
+def test_first_text_of_a_group_is_its_representative():
+    texts = ["Другой отзыв целиком", BASE + ".", BASE]
+
+    representatives, inverse = near_duplicate_groups(texts, threshold=0.8)
+
+    assert representatives.tolist() == [0, 1]
+    assert inverse.tolist() == [0, 1, 1]
+
+
+def test_empty_and_short_texts():
+    representatives, inverse = near_duplicate_groups(["", "", "да", "нет"])
+
+    assert representatives.tolist() == [0, 2, 3]
+    assert inverse.tolist() == [0, 0, 1, 2]
+    assert near_duplicate_groups([])[0].tolist() == []
+
+
+def test_shingle_hashes_are_unique_and_order_free():
+    hashes = shingle_hashes("абвабвабв", shingle_size=3)
+
+    assert len(hashes) == 3
+    assert np.array_equal(hashes, np.unique(hashes))
+
+
+def test_lsh_bands_split_the_signature():
+    for threshold in (0.5, 0.8, 0.9):
+        bands, rows = lsh_bands(64, threshold)
+        assert bands * rows == 64
+        assert (1.0 / bands) ** (1.0 / rows) <= threshold
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def vectors(n, dim=4, start=0):
+    return np.arange(start, start + n * dim, dtype=np.float32).reshape(n, dim) / 64
+
+
+def test_round_trip_across_instances(tmp_path):
+    EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20).add(["a", "b"], vectors(2))
+
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    found, missing = cache.lookup(["b", "c", "a"])
+
+    assert missing == [1]
+    np.testing.assert_allclose(found[0], vectors(2)[1], atol=1e-3)
+    np.testing.assert_allclose(found[2], vectors(2)[0], atol=1e-3)
+
+
+def test_models_do_not_share_entries(tmp_path):
+    EmbeddingCache(str(tmp_path), "model-a", max_bytes=1 << 20).add(["a"], vectors(1))
+
+    _, missing = EmbeddingCache(str(tmp_path), "model-b", max_bytes=1 << 20).lookup(["a"])
+
+    assert missing == [0]
+
+
+def test_eviction_keeps_recently_used_rows(tmp_path):
+    # Room for 4 rows of 4 float16 values; eviction compacts to 90%, i.e. 3 rows
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=4 * 4 * 2)
+    cache.add(["a", "b", "c", "d"], vectors(4))
+    atime = np.memmap(cache.atime_path, dtype=np.int64, mode="r+")
+    atime[:] = [100, 50, 300, 200]
+    atime.flush()
+
+    cache.add(["e"], vectors(1, start=16))
+
+    found, missing = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20).lookup(
+        ["a", "b", "c", "d", "e"]
+    )
+    assert missing == [0, 1]
+    np.testing.assert_allclose(found[4], vectors(1, start=16)[0], atol=1e-3)
+    assert cache.stats()["evictions"] == 2
+    assert sorted(os.listdir(cache.directory)) == [
+        ".lock",
+        "atime-1.i8",
+        "index.npz",
+        "vectors-1.f16",
+    ]
+
+
+def test_flush_updates_access_times_without_rewriting_the_index(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    cache.add(["a", "b"], vectors(2))
+    atime = np.memmap(cache.atime_path, dtype=np.int64, mode="r+")
+    atime[:] = 0
+    atime.flush()
+    index_mtime = os.stat(cache.index_path).st_mtime_ns
+
+    cache.lookup(["b"])
+    cache.flush()
+
+    assert list(np.fromfile(cache.atime_path, dtype=np.int64) > 0) == [False, True]
+    assert os.stat(cache.index_path).st_mtime_ns == index_mtime
+
+
+def test_rows_written_without_an_index_are_dropped(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    cache.add(["a"], vectors(1))
+    # A writer died after appending its rows, before saving the index
+    with open(cache.vectors_path, "ab") as f:
+        f.write(vectors(2, start=4).astype(np.float16).tobytes())
+
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    cache.add(["b"], vectors(1, start=8))
+
+    found, missing = cache.lookup(["a", "b"])
+    assert missing == []
+    np.testing.assert_allclose(found[1], vectors(1, start=8)[0], atol=1e-3)
+
+
+def test_index_rows_beyond_the_vector_file_are_not_hits(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    cache.add(["a", "b", "c"], vectors(3))
+    os.truncate(cache.vectors_path, 4 * 2)
+
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    found, missing = cache.lookup(["a", "b", "c"])
+    assert missing == [1, 2]
+
+    cache.add(["b"], vectors(1, start=20))
+    assert os.path.getsize(cache.vectors_path) == 2 * 4 * 2
+    np.testing.assert_allclose(cache.lookup(["b"])[0][0], vectors(1, start=20)[0], atol=1e-3)
+
+
+def test_generation_left_by_an_interrupted_eviction_is_ignored(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    cache.add(["a"], vectors(1))
+    # An eviction wrote the next generation, then died before saving the index
+    with open(os.path.join(cache.directory, "vectors-1.f16"), "wb") as f:
+        f.write(np.zeros((5, 4), dtype=np.float16).tobytes())
+
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=1 << 20)
+    np.testing.assert_allclose(cache.lookup(["a"])[0][0], vectors(1)[0], atol=1e-3)
+    cache.add(["b"], vectors(1, start=4))
+
+    assert not os.path.exists(os.path.join(cache.directory, "vectors-1.f16"))
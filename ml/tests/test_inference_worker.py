@@ -0,0 +1,197 @@
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("bertopic")
+pytest.importorskip("celery")
+
+import inference_worker
+
+
+class FakeStreamClient:
+    def __init__(self):
+        self.entries = []
+
+    def delete(self, key):
+        self.entries.clear()
+
+    def xadd(self, key, fields):
+        self.entries.append((fields["event"], json.loads(fields["data"])))
+
+    def expire(self, key, seconds):
+        pass
+
+
+class FakeTask:
+    class request:
+        id = None
+
+
+@pytest.fixture
+def stream_client(monkeypatch):
+    client = FakeStreamClient()
+    monkeypatch.setattr(inference_worker, "RESULT_STREAM", True)
+    monkeypatch.setattr(inference_worker.app.backend, "client", client, raising=False)
+    return client
+
+
+def test_stream_ends_with_done_when_the_task_raises(stream_client, monkeypatch):
+    def broken_reader(source):
+        raise RuntimeError("worker crashed")
+
+    monkeypatch.setattr(inference_worker, "read_reviews_by_source", broken_reader)
+
+    with pytest.raises(RuntimeError):
+        inference_worker.analyze_csv(
+            FakeTask(), "text,src\nхорошо,a\n", "analysis-1", "columnar", "inline"
+        )
+
+    assert [event for event, _ in stream_client.entries] == ["start", "done"]
+    assert stream_client.entries[-1][1]["status"] == "error"
+
+
+def test_stream_ends_with_done_on_a_bad_upload(stream_client):
+    result = inference_worker.analyze_csv(
+        FakeTask(), "a,b\n1,2\n", "analysis-1", "columnar", "inline"
+    )
+
+    assert result["status"] == "error"
+    assert stream_client.entries[-1] == ("done", result)
+
+
+def test_streaming_progress_never_goes_back():
+    class RecordingTask:
+        class request:
+            id = "task-1"
+
+        def __init__(self):
+            self.percents = []
+
+        def update_state(self, state, meta):
+            self.percents.append(meta["percent"])
+
+    task = RecordingTask()
+    progress = inference_worker.ProgressReporter(task, streaming=True)
+    progress.total_categories = 2
+    progress.stage("parse")
+    progress.stage("embed")
+    for idx in range(2):
+        progress.stage("topic-fit", idx)
+        progress.stage("umap", idx)
+        progress.stage("summarize", idx + 1)
+        progress.stage("sentiment", idx + 1)
+
+    assert task.percents == sorted(task.percents)
+    assert task.percents[-1] < 100
+
+
+def final_frame(with_ids=True):
+    df = pd.DataFrame(
+        {
+            "text": ["хорошо", "плохо"],
+            "src": ["shop", "shop"],
+            "sentiment": ["positive", "negative"],
+            "confidence": np.array([0.9, 0.7], dtype=np.float32),
+            "cluster_id": np.array([1, -1], dtype=np.int64),
+            "x": np.array([0.5, -1.0]),
+            "y": np.array([2.0, 0.25]),
+            "row": np.array([3, 0], dtype=np.int64),
+        }
+    )
+    if with_ids:
+        df["ID"] = ["r1", "r2"]
+    return df
+
+
+def test_review_columns_are_plain_json_lists():
+    columns = inference_worker.build_review_columns(final_frame())
+
+    assert columns["source_id"] == ["r1", "r2"]
+    assert columns["cluster_id"] == [1, -1]
+    assert columns["row"] == [3, 0]
+    assert columns["confidence"] == pytest.approx([0.9, 0.7])
+    assert json.loads(json.dumps(columns)) == columns
+
+
+def test_review_columns_fall_back_to_src_without_ids():
+    columns = inference_worker.build_review_columns(final_frame(with_ids=False))
+
+    assert columns["source_id"] == ["shop", "shop"]
+
+
+def test_records_and_columnar_results_carry_the_same_reviews():
+    columns = inference_worker.build_review_columns(final_frame())
+    clusters = [{"id": 1, "title": "Доставка", "summary": "..."}]
+
+    records = inference_worker.format_result(columns, clusters, "analysis-1", "records", "inline")
+    columnar = inference_worker.format_result(columns, clusters, "analysis-1", "columnar", "inline")
+
+    assert records["reviews"][0] == {
+        "source_id": "r1",
+        "text": "хорошо",
+        "sentiment": "positive",
+        "confidence": pytest.approx(0.9),
+        "cluster_id": 1,
+        "coords": {"x": 0.5, "y": 2.0},
+    }
+    assert columnar["format"] == "columnar"
+    assert columnar["review_columns"] is columns
+    assert records["clusters"] == columnar["clusters"] == clusters
+
+
+def read_artifact(directory, result):
+    assert result["format"] == "artifact"
+    with gzip.open(directory / result["artifact"]["path"], "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_artifact_leaves_text_out_for_shared_uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(inference_worker, "RESULT_STORE_DIR", str(tmp_path))
+    columns = inference_worker.build_review_columns(final_frame())
+
+    result = inference_worker.format_result(columns, [], "analysis-1", "columnar", "artifact")
+
+    stored = read_artifact(tmp_path, result)
+    assert "text" not in stored
+    assert stored["row"] == [3, 0]
+    assert result["counts"] == {"reviews": 2, "clusters": 0}
+    assert result["artifact"]["encoding"] == "json+gzip"
+
+
+def test_artifact_keeps_text_without_a_shared_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(inference_worker, "RESULT_STORE_DIR", str(tmp_path))
+    columns = inference_worker.build_review_columns(final_frame())
+
+    result = inference_worker.format_result(
+        columns, [], "analysis-1", "columnar", "artifact", keep_text=True
+    )
+
+    assert read_artifact(tmp_path, result) == columns
+
+
+def test_appends_persist_every_review_of_their_chain(tmp_path, monkeypatch):
+    monkeypatch.setattr(inference_worker, "ANALYSIS_STORE_DIR", str(tmp_path))
+    base_dir = tmp_path / "analysis-1"
+    (base_dir / "category-0").mkdir(parents=True)
+    pd.DataFrame({"text": ["a", "b"], "src": ["shop", "shop"]}).to_csv(
+        base_dir / "reviews.csv.gz", index=False, compression="gzip"
+    )
+    state = {"categories": {"shop": {"dir": "category-0", "remap": {"0": 0}}}, "clusters": []}
+    (base_dir / "state.json").write_text(json.dumps(state))
+
+    def batch(category, text):
+        return {category: pd.DataFrame({"text": [text], "src": [category], "row": [0]})}
+
+    inference_worker.save_appended_state("analysis-1", "analysis-2", state, batch("shop", "c"))
+    appended = inference_worker.load_analysis_state("analysis-2")
+    inference_worker.save_appended_state("analysis-2", "analysis-3", appended, batch("app", "d"))
+
+    chained = inference_worker.load_analysis_state("analysis-3")
+    model_dir = tmp_path / "analysis-3" / chained["categories"]["shop"]["dir"]
+    assert model_dir.resolve() == (base_dir / "category-0").resolve()
+    reviews = pd.read_csv(tmp_path / "analysis-3" / "reviews.csv.gz")
+    assert reviews["text"].tolist() == ["a", "b", "c", "d"]
+    assert reviews["src"].tolist() == ["shop", "shop", "shop", "app"]
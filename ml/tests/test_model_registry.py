@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from model_registry import ModelRegistry, resident_bytes
+
+
+class FakeModel:
+    """Stands in for a torch module with `size` bytes of parameters."""
+
+    def __init__(self, size):
+        self.weights = np.zeros(size, dtype=np.uint8)
+
+    def parameters(self):
+        return [FakeTensor(self.weights.nbytes)]
+
+    def buffers(self):
+        return []
+
+
+class FakeTensor:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+    def numel(self):
+        return self.nbytes
+
+    def element_size(self):
+        return 1
+
+
+def registry_with(budget, sizes, evicted=None):
+    registry = ModelRegistry(budget_bytes=budget)
+    for name, size in sizes.items():
+        registry.register(
+            name,
+            lambda size=size: FakeModel(size),
+            on_evict=(lambda name=name: evicted.append(name)) if evicted is not None else None,
+        )
+    return registry
+
+
+def test_least_recently_used_model_is_evicted_over_budget():
+    evicted = []
+    registry = registry_with(250, {"a": 100, "b": 100, "c": 100}, evicted)
+    registry.get("a")
+    registry.get("b")
+    registry.get("a")
+
+    registry.get("c")
+
+    assert evicted == ["b"]
+    assert registry.resident_total() == 200
+    assert registry.stats()["b"]["loaded"] is False
+
+
+def test_models_in_use_are_not_evicted():
+    evicted = []
+    registry = registry_with(150, {"a": 100, "b": 100}, evicted)
+
+    with registry.using("a") as model:
+        registry.get("b")
+        assert evicted == []
+        assert registry.stats()["a"]["users"] == 1
+    assert registry.get("a") is model
+
+    registry.get("b")
+    registry.evict("b")
+    registry.get("b")
+    assert evicted == ["b", "a"]
+
+
+def test_pinned_models_survive_budget_and_idle_eviction():
+    registry = registry_with(150, {"a": 100, "b": 100})
+    registry.idle_timeout = 1e-9
+    registry.preload(["a"])
+    registry.pin(["a"])
+
+    registry.get("b")
+    registry.evict_idle()
+
+    assert registry.stats()["a"]["loaded"] is True
+    assert registry.stats()["b"]["loaded"] is False
+
+
+def test_evicted_model_is_reloaded_on_next_get():
+    registry = registry_with(0, {"a": 10})
+    first = registry.get("a")
+    registry.evict("a")
+
+    assert registry.get("a") is not first
+    assert registry.stats()["a"]["loads"] == 2
+
+
+def test_onnx_session_size_is_read_from_the_graph_file(tmp_path):
+    graph = tmp_path / "model.onnx"
+    graph.write_bytes(b"\0" * 1234)
+
+    class OnnxEngine:
+        model = None
+        session = object()
+        onnx_path = str(graph)
+
+    assert resident_bytes(OnnxEngine()) == 1234
+    (tmp_path / "model.onnx.data").write_bytes(b"\0" * 100)
+    assert resident_bytes(OnnxEngine()) == 1334
+
+
+def test_torch_module_size_counts_parameters():
+    torch = pytest.importorskip("torch")
+
+    assert resident_bytes(torch.nn.Linear(4, 2)) == (4 * 2 + 2) * 4
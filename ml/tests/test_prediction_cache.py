@@ -0,0 +1,83 @@
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+class FakeRedis:
+    """Just enough of redis.Redis for the shared tier, with TTLs recorded."""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def mget(self, keys):
+        return [self.values.get(k) for k in keys]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+
+    def execute(self):
+        return []
+
+
+def row(value):
+    return np.full(3, value, dtype=np.float32)
+
+
+def test_round_trip_by_position():
+    cache = PredictionCache(10)
+    keys = [PredictionCache.key("fp", text) for text in ("a", "b", "c")]
+    cache.put_many({keys[0]: row(0), keys[2]: row(2)})
+
+    found = cache.get_many(keys)
+
+    assert sorted(found) == [0, 2]
+    np.testing.assert_array_equal(found[2], row(2))
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_key_depends_on_the_fingerprint():
+    assert PredictionCache.key("a", "text") != PredictionCache.key("b", "text")
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PredictionCache(2)
+    cache.put_many({"a": row(0), "b": row(1)})
+    cache.get_many(["a"])
+    cache.put_many({"c": row(2)})
+
+    assert sorted(cache.get_many(["a", "b", "c"])) == [0, 2]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_redis_tier_is_filled_with_ttl_and_promotes_hits():
+    redis = FakeRedis()
+    writer = PredictionCache(10, ttl_seconds=60)
+    writer.redis = redis
+    writer.put_many({"a": row(1)})
+    assert redis.ttls == {"sentiment-cache:a": 60}
+
+    reader = PredictionCache(10)
+    reader.redis = redis
+    np.testing.assert_array_equal(reader.get_many(["a"])[0], row(1))
+    assert reader.stats()["redis_hits"] == 1
+
+    redis.values.clear()
+    assert 0 in reader.get_many(["a"])
+    assert reader.stats()["hits"] == 1
+
+
+def test_redis_errors_fall_back_to_misses():
+    class BrokenRedis(FakeRedis):
+        def mget(self, keys):
+            raise ConnectionError("down")
+
+    cache = PredictionCache(10)
+    cache.redis = BrokenRedis()
+
+    assert cache.get_many(["a"]) == {}
+    assert cache.stats()["redis_errors"] == 1
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from fast_classifier import FastClassifier
+from prediction_cache import PredictionCache
+from sentiment_engine import (
+    TIER_CACHE,
+    TIER_FAST,
+    TIER_TRANSFORMER,
+    SentimentEngine,
+    length_buckets,
+)
+from utils.instrumentation import Metrics
+
+TRAIN_TEXTS = [
+    "ужасный сервис, никогда больше",
+    "обычная доставка, ничего особенного",
+    "отличный магазин, всем советую",
+] * 20
+TRAIN_LABELS = [0, 1, 2] * 20
+TEXTS = [
+    "ужасный сервис, никогда больше",
+    "длинный отзыв про то, как курьер опоздал на два часа и не позвонил",
+    "отличный магазин, всем советую",
+    "обычная доставка, ничего особенного",
+    "странный текст без явной оценки",
+]
+
+
+def test_length_buckets_stay_within_the_token_budget():
+    lengths = [5, 40, 12, 40, 3, 20, 7]
+    buckets = length_buckets(lengths, token_budget=60)
+
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(lengths)))
+    for bucket in buckets:
+        assert len(bucket) * max(lengths[i] for i in bucket) <= 60
+    assert buckets[0][0] in (1, 3)
+
+
+def test_length_buckets_keep_an_oversized_row_alone():
+    assert length_buckets([100, 2, 2], token_budget=10) == [[0], [1, 2]]
+
+
+def test_padded_buckets_match_one_text_at_a_time(tiny_model_dir):
+    metrics = Metrics("test")
+    engine = SentimentEngine(tiny_model_dir, device="cpu", chunk_size=3, metrics=metrics)
+    single = SentimentEngine(tiny_model_dir, device="cpu", chunk_size=1)
+
+    probs = engine.predict_proba(TEXTS)
+
+    np.testing.assert_allclose(probs, single.predict_proba(TEXTS), atol=1e-5)
+    counters = metrics.summary()["counters"]
+    assert counters["texts"] == len(TEXTS)
+    assert counters["batches"] == 2
+
+
+def test_token_budget_splits_forward_batches(tiny_model_dir):
+    metrics = Metrics("test")
+    engine = SentimentEngine(tiny_model_dir, device="cpu", token_budget=1, metrics=metrics)
+
+    engine.predict_proba(TEXTS)
+
+    # Every row exceeds a 1-token budget, so each runs in a bucket of its own
+    assert metrics.summary()["counters"]["batches"] == len(TEXTS)
+
+
+def test_empty_input(tiny_model_dir):
+    engine = SentimentEngine(tiny_model_dir, device="cpu")
+
+    labels, confidences = engine.predict([])
+
+    assert labels.shape == (0,) and confidences.shape == (0,)
+    assert engine.predict_proba_with_tiers([])[0].shape == (0, 3)
+
+
+@pytest.fixture(scope="module")
+def fast_model_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("fast") / "fast.joblib")
+    FastClassifier.train(TRAIN_TEXTS, TRAIN_LABELS).save(path)
+    return path
+
+
+def test_cascade_answers_a_whole_chunk_with_the_fast_tier(tiny_model_dir, fast_model_path):
+    engine = SentimentEngine(
+        tiny_model_dir, device="cpu", fast_model_path=fast_model_path, cascade_threshold=0.0
+    )
+    probs, tiers = engine.predict_proba_with_tiers(TEXTS)
+
+    expected = engine.fast_model.predict_proba(TEXTS, engine.num_labels)
+    assert (tiers == TIER_FAST).all()
+    np.testing.assert_allclose(probs, expected, atol=1e-5)
+
+
+def test_cascade_keeps_input_order_for_a_mixed_chunk(tiny_model_dir, fast_model_path):
+    fast = FastClassifier.load(fast_model_path).predict_proba(TEXTS).max(axis=1)
+    threshold = float(np.median(fast))
+    engine = SentimentEngine(
+        tiny_model_dir,
+        device="cpu",
+        chunk_size=2,
+        fast_model_path=fast_model_path,
+        cascade_threshold=threshold,
+    )
+    plain = SentimentEngine(tiny_model_dir, device="cpu")
+
+    probs, tiers = engine.predict_proba_with_tiers(TEXTS)
+
+    confident = fast >= threshold
+    assert 0 < confident.sum() < len(TEXTS)
+    np.testing.assert_array_equal(tiers, np.where(confident, TIER_FAST, TIER_TRANSFORMER))
+    expected = np.where(
+        confident[:, None], engine.fast_model.predict_proba(TEXTS), plain.predict_proba(TEXTS)
+    )
+    np.testing.assert_allclose(probs, expected, atol=1e-5)
+
+
+def test_repeated_call_is_answered_from_the_cache(tiny_model_dir):
+    engine = SentimentEngine(tiny_model_dir, device="cpu", cache=PredictionCache(100))
+    first, first_tiers = engine.predict_proba_with_tiers(TEXTS)
+    second, second_tiers = engine.predict_proba_with_tiers(TEXTS)
+
+    assert (first_tiers == TIER_TRANSFORMER).all()
+    assert (second_tiers == TIER_CACHE).all()
+    np.testing.assert_allclose(second, first, atol=1e-6)
+
+
+def test_cache_hits_and_misses_in_one_chunk(tiny_model_dir):
+    engine = SentimentEngine(tiny_model_dir, device="cpu", cache=PredictionCache(100))
+    plain = SentimentEngine(tiny_model_dir, device="cpu")
+    engine.predict_proba(TEXTS[:2])
+
+    texts = TEXTS + [TEXTS[3]]
+    probs, tiers = engine.predict_proba_with_tiers(texts)
+
+    np.testing.assert_array_equal(tiers, [TIER_CACHE] * 2 + [TIER_TRANSFORMER] * 4)
+    np.testing.assert_allclose(probs, plain.predict_proba(texts), atol=1e-5)
+    assert engine.cache.stats()["entries"] == len(TEXTS)
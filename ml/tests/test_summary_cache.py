@@ -0,0 +1,59 @@
+import pytest
+
+import summary_cache
+from summary_cache import SummaryCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(summary_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_round_trip(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60, max_entries=10)
+    cache.put_many({"a": {"title": "Доставка", "description": "Курьеры опаздывают"}})
+
+    assert cache.get_many(["a", "b", "a"]) == {
+        "a": {"title": "Доставка", "description": "Курьеры опаздывают"}
+    }
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_key_ignores_keyword_and_document_order():
+    key = SummaryCache.key("qwen", "template", ["a", "b"], ["x", "y"])
+
+    assert key == SummaryCache.key("qwen", "template", ["b", "a"], ["y", "x"])
+    assert key != SummaryCache.key("other", "template", ["a", "b"], ["x", "y"])
+
+
+def test_entries_expire_after_ttl(tmp_path, clock):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60, max_entries=10)
+    cache.put_many({"a": {"title": "a"}})
+
+    clock[0] += 59
+    assert "a" in cache.get_many(["a"])
+    clock[0] += 2
+    assert cache.get_many(["a"]) == {}
+
+
+def test_least_recently_read_entries_are_dropped(tmp_path, clock):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=3600, max_entries=2)
+    cache.put_many({"a": {"title": "a"}})
+    clock[0] += 1
+    cache.put_many({"b": {"title": "b"}})
+    clock[0] += 1
+    cache.get_many(["a"])
+    clock[0] += 1
+
+    cache.put_many({"c": {"title": "c"}})
+
+    assert sorted(cache.get_many(["a", "b", "c"])) == ["a", "c"]
+
+
+def test_entries_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    SummaryCache(path, ttl_seconds=60, max_entries=10).put_many({"a": {"title": "a"}})
+
+    assert "a" in SummaryCache(path, ttl_seconds=60, max_entries=10).get_many(["a"])
@@ -1,11 +1,11 @@
 import argparse
+import hashlib
 import os
 from typing import Dict
 
 import numpy as np
-import pandas as pd
 import torch
-from datasets import Dataset
+import torch.nn.functional as F
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 from transformers import (
@@ -15,14 +15,16 @@ from transformers import (
     TrainingArguments,
 )
 
-from preprocess import batch_clean_text, get_tokenizer
+from fast_classifier import FastClassifier
+from preprocess import file_sha256, get_tokenizer, load_csv, prepare_dataset
+from sentiment_engine import SentimentEngine
 from utils.metrics import macro_f1
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Train sentiment classifier")
     parser.add_argument("--train_path", type=str, default="train.csv", help="Path to train.csv")
-    parser.add_argument("--model_name", type=str, required=True, help="HuggingFace model name or path")
+    parser.add_argument("--model_name", type=str, default=None, help="HuggingFace model name or path (required unless --fast_only)")
     parser.add_argument("--output_dir", type=str, default="checkpoints", help="Where to save checkpoints")
     parser.add_argument("--max_length", type=int, default=256)
     parser.add_argument("--batch_size", type=int, default=16)
@@ -43,21 +45,149 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--save_steps", type=int, default=500)
     parser.add_argument("--fp16", action="store_true", help="Enable FP16 mixed precision (CUDA only)")
     parser.add_argument("--bf16", action="store_true", help="Enable BF16 mixed precision (Ampere GPU/CPU support)")
+    parser.add_argument("--dataset_cache_dir", type=str, default="dataset_cache", help="Where tokenized datasets are cached ('' to disable)")
+    parser.add_argument("--no_group_by_length", action="store_true", help="Sample batches randomly instead of grouping rows of similar length")
+    parser.add_argument("--distill_from", type=str, default=None, help="Teacher model directory; trains --model_name as a student on its soft labels")
+    parser.add_argument("--temperature", type=float, default=2.0, help="Softmax temperature for distillation")
+    parser.add_argument("--distill_alpha", type=float, default=0.7, help="Weight of the soft-label loss vs. the hard-label loss")
+    parser.add_argument("--fast_model_path", type=str, default=None, help="Also train the hashed n-gram cascade model and save it here (.joblib)")
+    parser.add_argument("--fast_only", action="store_true", help="Train only the cascade model, skip the transformer")
+    parser.add_argument("--cascade_threshold", type=float, default=0.9, help="Confidence threshold reported for the cascade model")
     return parser.parse_args()
 
 
 def compute_metrics(eval_pred) -> Dict[str, float]:
     logits, labels = eval_pred
+    if isinstance(labels, (tuple, list)):
+        # Distillation also passes the teacher logits as a label column
+        labels = labels[0]
     preds = np.argmax(logits, axis=1)
     metrics = macro_f1(preds, labels)
     metrics["accuracy"] = accuracy_score(labels, preds)
     return metrics
 
 
+def split_indices(labels: np.ndarray, args: argparse.Namespace):
+    """Stratified train/validation split of row indices; validation is None when disabled."""
+    if args.no_eval or args.eval_ratio <= 0:
+        return np.arange(len(labels)), None
+    return train_test_split(
+        np.arange(len(labels)),
+        test_size=args.eval_ratio,
+        stratify=labels,
+        random_state=args.seed,
+    )
+
+
+def train_fast_model(args: argparse.Namespace) -> None:
+    """Trains the cascade's hashed n-gram model on the same split as the transformer."""
+    df = load_csv(args.train_path)
+    if "label" not in df.columns:
+        raise ValueError("train.csv must contain a 'label' column")
+    texts = df["text"].astype(str).to_numpy()
+    labels = df["label"].astype(int).to_numpy()
+    train_idx, val_idx = split_indices(labels, args)
+
+    fast_model = FastClassifier.train(texts[train_idx], labels[train_idx], seed=args.seed)
+    fast_model.save(args.fast_model_path)
+    print("Cascade model saved to", os.path.abspath(args.fast_model_path))
+
+    if val_idx is not None:
+        probs = fast_model.predict_proba(texts[val_idx].tolist())
+        preds = probs.argmax(axis=1)
+        confident = probs.max(axis=1) >= args.cascade_threshold
+        metrics = macro_f1(preds, labels[val_idx])
+        metrics["accuracy"] = accuracy_score(labels[val_idx], preds)
+        metrics["coverage"] = float(confident.mean())
+        if confident.any():
+            metrics["accuracy_when_confident"] = accuracy_score(labels[val_idx][confident], preds[confident])
+        print("Cascade model validation:", metrics)
+
+
+def teacher_fingerprint(teacher: str) -> str:
+    """Identifies a local teacher checkpoint by its files' names, sizes and mtimes."""
+    if not os.path.isdir(teacher):
+        return teacher
+    parts = [os.path.abspath(teacher)]
+    for name in sorted(os.listdir(teacher)):
+        stat = os.stat(os.path.join(teacher, name))
+        parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "\0".join(parts)
+
+
+def load_teacher_logits(args: argparse.Namespace) -> np.ndarray:
+    """
+    Runs the teacher over the training CSV once and caches its logits in
+    --dataset_cache_dir, keyed by the CSV contents, the teacher and max_length.
+    Rows line up with `prepare_dataset` since both read the CSV with `load_csv`.
+    """
+    cache_path = None
+    if args.dataset_cache_dir:
+        payload = "\0".join(
+            [file_sha256(args.train_path), teacher_fingerprint(args.distill_from), str(args.max_length)]
+        )
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+        cache_path = os.path.join(args.dataset_cache_dir, f"teacher-{key}.npy")
+        if os.path.exists(cache_path):
+            print("Loading teacher logits from", cache_path)
+            return np.load(cache_path)
+
+    print("Computing teacher logits with", args.distill_from)
+    teacher = SentimentEngine(args.distill_from, max_length=args.max_length)
+    logits = teacher.predict_logits(load_csv(args.train_path)["text"].tolist())
+    del teacher
+
+    if cache_path is not None:
+        os.makedirs(args.dataset_cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".tmp.npy"
+        np.save(tmp_path, logits)
+        os.replace(tmp_path, cache_path)
+    return logits
+
+
+class DistillationTrainer(Trainer):
+    """
+    Trains on a mix of the teacher's temperature-softened probabilities (KL
+    divergence, scaled by T^2) and the hard labels (cross-entropy).
+    """
+
+    def __init__(self, *args, temperature: float = 2.0, alpha: float = 0.7, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        inputs = dict(inputs)
+        teacher_logits = inputs.pop("teacher_logits")
+        labels = inputs.pop("labels")
+        outputs = model(**inputs)
+
+        t = self.temperature
+        soft_loss = F.kl_div(
+            F.log_softmax(outputs.logits / t, dim=-1),
+            F.softmax(teacher_logits / t, dim=-1),
+            reduction="batchmean",
+        ) * (t * t)
+        hard_loss = F.cross_entropy(
+            outputs.logits, labels, label_smoothing=self.args.label_smoothing_factor
+        )
+        loss = self.alpha * soft_loss + (1 - self.alpha) * hard_loss
+        return (loss, outputs) if return_outputs else loss
+
+
 def main() -> None:
     args = parse_args()
     if args.fp16 and args.bf16:
         raise ValueError("Choose only one of fp16 or bf16.")
+    if args.fast_only and not args.fast_model_path:
+        raise ValueError("--fast_only requires --fast_model_path.")
+    if not args.fast_only and not args.model_name:
+        raise ValueError("--model_name is required unless --fast_only is set.")
+
+    if args.fast_model_path:
+        train_fast_model(args)
+        if args.fast_only:
+            return
 
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
@@ -67,51 +197,30 @@ def main() -> None:
         torch.set_float32_matmul_precision("medium")
     print(f"Using device: {device}")
 
-    df = pd.read_csv(args.train_path)
-    if "label" not in df.columns:
-        raise ValueError("train.csv must contain a 'label' column")
-
-    df["text"] = batch_clean_text(df["text"].tolist())
-    df["label"] = df["label"].astype(int)
-
-    do_eval = not args.no_eval and args.eval_ratio > 0
-    if do_eval:
-        train_df, val_df = train_test_split(
-            df,
-            test_size=args.eval_ratio,
-            stratify=df["label"],
-            random_state=args.seed,
-        )
-    else:
-        train_df, val_df = df, None
-
     tokenizer = get_tokenizer(args.model_name, max_length=args.max_length)
+    dataset = prepare_dataset(
+        args.train_path,
+        tokenizer=tokenizer,
+        max_length=args.max_length,
+        cache_dir=args.dataset_cache_dir or None,
+    )
+    if "labels" not in dataset.column_names:
+        raise ValueError("train.csv must contain a 'label' column")
+    if args.distill_from:
+        teacher_logits = load_teacher_logits(args)
+        if len(teacher_logits) != len(dataset):
+            raise ValueError("Teacher logits do not line up with the training rows")
+        dataset = dataset.add_column("teacher_logits", teacher_logits.tolist())
 
-    train_ds = Dataset.from_pandas(train_df.reset_index(drop=True))
-    val_ds = Dataset.from_pandas(val_df.reset_index(drop=True)) if val_df is not None else None
+    train_idx, val_idx = split_indices(np.asarray(dataset["labels"]), args)
+    do_eval = val_idx is not None
+    train_ds = dataset.select(train_idx) if do_eval else dataset
+    val_ds = dataset.select(val_idx) if do_eval else None
 
     label_names = {0: "negative", 1: "neutral", 2: "positive"}
     id2label = {i: label_names[i] for i in range(3)}
     label2id = {v: k for k, v in id2label.items()}
 
-    def tokenize_function(examples):
-        return tokenizer(
-            examples["text"],
-            padding="max_length",
-            truncation=True,
-            max_length=args.max_length,
-        )
-
-    remove_cols = [c for c in train_ds.column_names if c not in {"label"}]
-    train_ds = train_ds.map(tokenize_function, batched=True, remove_columns=remove_cols)
-    val_ds = val_ds.map(tokenize_function, batched=True, remove_columns=remove_cols) if val_ds is not None else None
-    train_ds = train_ds.rename_column("label", "labels")
-    if val_ds is not None:
-        val_ds = val_ds.rename_column("label", "labels")
-    train_ds.set_format(type="torch")
-    if val_ds is not None:
-        val_ds.set_format(type="torch")
-
     model = AutoModelForSequenceClassification.from_pretrained(
         args.model_name,
         num_labels=3,
@@ -148,11 +257,19 @@ def main() -> None:
         greater_is_better=True,
         save_total_limit=2,
         report_to="none",
+        group_by_length=not args.no_group_by_length,
+        # Listing the teacher logits as a label column keeps the Trainer from dropping it
+        label_names=["labels", "teacher_logits"] if args.distill_from else None,
         fp16=args.fp16,
         bf16=args.bf16,
     )
 
-    trainer = Trainer(
+    trainer_cls, trainer_kwargs = Trainer, {}
+    if args.distill_from:
+        trainer_cls = DistillationTrainer
+        trainer_kwargs = {"temperature": args.temperature, "alpha": args.distill_alpha}
+
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_ds,
@@ -160,6 +277,7 @@ def main() -> None:
         tokenizer=tokenizer,
         data_collator=data_collator,
         compute_metrics=compute_metrics if do_eval else None,
+        **trainer_kwargs,
     )
 
     trainer.train()
@@ -0,0 +1,140 @@
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process (Linux), 0 if unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    """High-water mark of the resident set size since the last `reset_peak_rss`."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    # ru_maxrss is in KB on Linux and covers the whole process lifetime
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> None:
+    """Resets the RSS high-water mark so it can be measured per task (Linux 4.0+)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class Metrics:
+    """
+    Low-overhead stage timers and counters.
+
+    `timer(stage)` records count/sum/max wall time per stage and also works as
+    a function decorator, `inc(name, n)` bumps a counter. `summary()` returns
+    a JSON-friendly dict, `merge()` adds one from a child process, and
+    `render_prometheus()` returns the Prometheus text format.
+    """
+
+    def __init__(self, namespace: str) -> None:
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._stages: Dict[str, list] = {}
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._gauges = {}
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def merge(self, summary: dict) -> None:
+        """Folds in the stages and counters of another process's `summary()`."""
+        with self._lock:
+            for stage, other in summary.get("stages", {}).items():
+                stats = self._stages.setdefault(stage, [0, 0.0, 0.0])
+                stats[0] += other["count"]
+                stats[1] += other["seconds"]
+                stats[2] = max(stats[2], other["max_seconds"])
+            for name, value in summary.get("counters", {}).items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {"count": count, "seconds": total, "max_seconds": longest}
+                    for stage, (count, total, longest) in self._stages.items()
+                },
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+
+    def render_prometheus(self, extra_gauges: Optional[Dict[str, float]] = None) -> str:
+        ns = self.namespace
+        lines = []
+        with self._lock:
+            stages = {stage: list(stats) for stage, stats in self._stages.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        gauges.update(extra_gauges or {})
+        gauges["rss_bytes"] = current_rss_bytes()
+        gauges["peak_rss_bytes"] = peak_rss_bytes()
+
+        if stages:
+            lines.append(f"# TYPE {ns}_stage_seconds summary")
+            for stage, (count, total, _) in sorted(stages.items()):
+                lines.append(f'{ns}_stage_seconds_count{{stage="{stage}"}} {count}')
+                lines.append(f'{ns}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f"# TYPE {ns}_stage_seconds_max gauge")
+            for stage, (_, _, longest) in sorted(stages.items()):
+                lines.append(f'{ns}_stage_seconds_max{{stage="{stage}"}} {longest:.6f}')
+        for name, value in sorted(counters.items()):
+            metric = f"{ns}_{_metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in sorted(gauges.items()):
+            metric = f"{ns}_{_metric_name(name)}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)